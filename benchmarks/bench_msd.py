@@ -0,0 +1,83 @@
+"""Compare the MSD tokenizer against the original per-character implementation.
+
+Run from the project root: `python benchmarks/bench_msd.py`
+"""
+import sys
+import timeit
+from io import StringIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "steps2blocks"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from smmap import read_msd_from_string  # noqa: E402
+from synth import synthetic_sm  # noqa: E402
+
+
+def legacy_read_msd_from_string(s: str, escape_chars: bool) -> list[list[str]]:
+    """The original character-at-a-time tokenizer, kept as a reference."""
+
+    values = []
+    param_buffer = StringIO()
+    reading_value = False
+    i = 0
+
+    while i < len(s):
+        if s[i:i + 2] == "//":
+            i = i + 2
+            while i < len(s) and s[i] != "\n":
+                i += 1
+            i += 1
+            continue
+
+        if s[i] == "#" and not reading_value:
+            values.append([])
+            reading_value = True
+
+        if not reading_value:
+            if escape_chars and s[i] == "\\":
+                i += 2
+            else:
+                i += 1
+            continue
+
+        if s[i] in ":;":
+            values[-1].append(param_buffer.getvalue())
+            param_buffer = StringIO()
+
+        if s[i] in "#:":
+            i += 1
+            continue
+
+        if s[i] == ";":
+            reading_value = False
+            i += 1
+            continue
+
+        if escape_chars and s[i] == "\\":
+            i += 1
+
+        if i < len(s):
+            param_buffer.write(s[i])
+
+        i += 1
+
+    if reading_value:
+        raise ValueError("Reached EOF while parsing a value.")
+
+    return values
+
+
+def main():
+    print(f"{'size':>10} {'legacy':>10} {'scanner':>10} {'speedup':>8}")
+    for measures in (16, 64, 256, 1024):
+        data = synthetic_sm(measures, charts=5)
+        assert read_msd_from_string(data, True) == legacy_read_msd_from_string(data, True)
+        number = max(1, 20000 // measures)
+        legacy = min(timeit.repeat(lambda: legacy_read_msd_from_string(data, True), number=number, repeat=3)) / number
+        scanner = min(timeit.repeat(lambda: read_msd_from_string(data, True), number=number, repeat=3)) / number
+        print(f"{len(data):>10} {legacy * 1000:>8.2f}ms {scanner * 1000:>8.2f}ms {legacy / scanner:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
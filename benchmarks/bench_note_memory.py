@@ -0,0 +1,35 @@
+"""Compare the memory used by `NoteArray` against a plain `list[Note]`.
+
+Run from the project root: `python benchmarks/bench_note_memory.py`
+"""
+import sys
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "steps2blocks"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from synth import synthetic_sm  # noqa: E402
+from smmap import read_msd_from_string, decode_notes  # noqa: E402
+
+
+def measure(build) -> tuple[int, int]:
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(result), size
+
+
+def main():
+    print(f"{'notes':>9} {'list[Note]':>12} {'NoteArray':>12} {'ratio':>7}")
+    for measures in (64, 512, 4096):
+        note_data = read_msd_from_string(synthetic_sm(measures, charts=1), True)[-1][6]
+        notes = decode_notes(note_data)
+        count, list_size = measure(lambda: list(notes))
+        _, array_size = measure(lambda: decode_notes(note_data))
+        print(f"{count:>9} {list_size / 1024:>10.1f}kB {array_size / 1024:>10.1f}kB {list_size / array_size:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
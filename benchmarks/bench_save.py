@@ -0,0 +1,47 @@
+"""Compare writing difficulty files with `DifficultyBeatmap.write_json` against `json.dump(data_dict())`.
+
+Run from the project root: `python benchmarks/bench_save.py`
+"""
+import json
+import sys
+import time
+import tracemalloc
+from io import StringIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from synth import synthetic_difficulty  # noqa: E402
+
+
+def measure(write) -> tuple[float, int]:
+    start = time.perf_counter()
+    write()
+    elapsed = time.perf_counter() - start
+
+    # timed separately, tracemalloc slows everything down a lot
+    tracemalloc.start()
+    write()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    print(f"{'notes':>8} {'json.dump':>20} {'write_json':>20}")
+    for notes in (1000, 10000, 50000):
+        dm = synthetic_difficulty(notes)
+
+        expected, actual = StringIO(), StringIO()
+        json.dump(dm.data_dict(), expected)
+        dm.write_json(actual)
+        assert expected.getvalue() == actual.getvalue()
+
+        dump_time, dump_peak = measure(lambda: json.dump(dm.data_dict(), StringIO()))
+        write_time, write_peak = measure(lambda: dm.write_json(StringIO()))
+        print(f"{notes:>8} {dump_time * 1000:>8.1f}ms {dump_peak / 2 ** 20:>7.1f}MiB"
+              f" {write_time * 1000:>8.1f}ms {write_peak / 2 ** 20:>7.1f}MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Benchmark the whole pipeline at several scales and compare the results against a baseline.
+
+Run from the project root: `python benchmarks/run.py --save results.json`, then after a change
+`python benchmarks/run.py --baseline results.json` reports benchmarks that got slower than the
+threshold and exits with status 1 if there are any.
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+from typing import Callable, Iterator, NamedTuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "steps2blocks"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from bsmap import BeatMap  # noqa: E402
+from convert import beatmap_from_sm  # noqa: E402
+from smcache import save_cache, load_cache  # noqa: E402
+from smmap import read_msd_from_string, load_sm  # noqa: E402
+from synth import synthetic_sm, synthetic_beatmap, ROW_DENSITIES  # noqa: E402
+
+
+class Scale(NamedTuple):
+    measures: int  # per chart of the .sm file
+    charts: int
+    bpm_changes: int
+    notes: int  # per difficulty of the Beat Saber map
+
+
+SCALES = {
+    "small": Scale(32, 2, 0, 1000),
+    "medium": Scale(256, 5, 8, 10000),
+    "large": Scale(2048, 5, 64, 50000),
+}
+
+
+class Benchmark(NamedTuple):
+    name: str
+    # sets up everything needed in the given temporary directory and returns the function to time
+    setup: Callable[[Scale, Path], Callable[[], object]]
+
+
+def _sm_text(scale: Scale) -> str:
+    return synthetic_sm(scale.measures, scale.charts, densities=ROW_DENSITIES, bpm_changes=scale.bpm_changes,
+                        hold_rate=0.02)
+
+
+def _sm_file(scale: Scale, tmp: Path) -> Path:
+    sm_path = tmp / "song.sm"
+    sm_path.write_text(_sm_text(scale), encoding="utf-8")
+    return sm_path
+
+
+def _setup_read_msd(scale: Scale, tmp: Path):
+    data = _sm_text(scale)
+    return lambda: read_msd_from_string(data, True)
+
+
+def _setup_load_sm(scale: Scale, tmp: Path):
+    sm_path = str(_sm_file(scale, tmp))
+    return lambda: load_sm(sm_path)
+
+
+def _setup_load_cache(scale: Scale, tmp: Path):
+    sm_path = _sm_file(scale, tmp)
+    cache_path = tmp / "song.smc"
+    save_cache(load_sm(str(sm_path)), cache_path, sm_path)
+    return lambda: load_cache(cache_path, sm_path)
+
+
+def _setup_beatmap_from_sm(scale: Scale, tmp: Path):
+    sm_song = load_sm(str(_sm_file(scale, tmp)))
+    for chart in sm_song.charts:
+        chart.notes  # decode up front, load_sm is measured on its own
+    return lambda: beatmap_from_sm(sm_song)
+
+
+def _setup_save_to_disk(scale: Scale, tmp: Path):
+    bm = synthetic_beatmap(scale.notes, scale.charts, scale.bpm_changes)
+    return lambda: bm.save_to_disk(tmp / "map")
+
+
+def _setup_load_from_file(scale: Scale, tmp: Path):
+    synthetic_beatmap(scale.notes, scale.charts, scale.bpm_changes).save_to_disk(tmp / "map")
+    return lambda: BeatMap.load_from_file(tmp / "map")
+
+
+def _map_files(path: Path) -> dict[str, bytes]:
+    return {file.name: file.read_bytes() for file in path.iterdir()}
+
+
+def _setup_resave_lazy(scale: Scale, tmp: Path):
+    map_path = tmp / "map"
+    synthetic_beatmap(scale.notes, scale.charts, scale.bpm_changes).save_to_disk(map_path)
+    # saving a lazily loaded map over its own files must leave them as they were
+    files = _map_files(map_path)
+    BeatMap.load_from_file(map_path, lazy=True).save_to_disk(map_path)
+    if _map_files(map_path) != files:
+        raise AssertionError("saving a lazily loaded map in place changed its files")
+    return lambda: BeatMap.load_from_file(map_path, lazy=True).save_to_disk(map_path)
+
+
+BENCHMARKS = (
+    Benchmark("read_msd_from_string", _setup_read_msd),
+    Benchmark("load_sm", _setup_load_sm),
+    Benchmark("load_cache", _setup_load_cache),
+    Benchmark("beatmap_from_sm", _setup_beatmap_from_sm),
+    Benchmark("save_to_disk", _setup_save_to_disk),
+    Benchmark("load_from_file", _setup_load_from_file),
+    Benchmark("resave_lazy", _setup_resave_lazy),
+)
+
+
+def run(scales: list[str], benchmark_names: list[str], min_time: float = 0.5) -> Iterator[tuple[str, float]]:
+    """Yield (benchmark[scale], best seconds per call) for every benchmark at every scale."""
+    for benchmark in BENCHMARKS:
+        if benchmark_names and benchmark.name not in benchmark_names:
+            continue
+        for scale_name in scales:
+            with tempfile.TemporaryDirectory() as tmp:
+                fn = benchmark.setup(SCALES[scale_name], Path(tmp))
+                timer = timeit.Timer(fn)
+                number, elapsed = timer.autorange()
+                repeat = max(3, min(10, int(min_time / elapsed))) if elapsed > 0 else 3
+                best = min([elapsed] + timer.repeat(repeat - 1, number)) / number
+            yield f"{benchmark.name}[{scale_name}]", best
+
+
+def compare(results: dict[str, float], baseline: dict[str, float], threshold: float) -> list[str]:
+    """Names of the benchmarks that are more than `threshold` (a fraction) slower than in the baseline."""
+    return [name for name, seconds in results.items()
+            if name in baseline and seconds > baseline[name] * (1 + threshold)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["small", "medium"],
+                        help="scales to run at (default: small medium)")
+    parser.add_argument("--only", nargs="+", choices=[benchmark.name for benchmark in BENCHMARKS], default=[],
+                        help="only run these benchmarks")
+    parser.add_argument("--save", type=Path, help="write the results to this JSON file")
+    parser.add_argument("--baseline", type=Path, help="compare against results saved earlier with --save")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown relative to the baseline that counts as a regression (default: 0.1)")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline is not None:
+        with args.baseline.open("rt", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    results = {}
+    print(f"{'benchmark':<32} {'time':>12} {'baseline':>12} {'change':>8}")
+    for name, seconds in run(args.scales, args.only):
+        results[name] = seconds
+        line = f"{name:<32} {seconds * 1000:>10.3f}ms"
+        if name in baseline:
+            line += f" {baseline[name] * 1000:>10.3f}ms {(seconds / baseline[name] - 1) * 100:>+7.1f}%"
+        print(line, flush=True)
+
+    if args.save is not None:
+        with args.save.open("wt", encoding="utf-8") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "results": results
+            }, f, indent=2)
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regressed by more than {args.threshold:.0%}:", file=sys.stderr)
+        for name in regressions:
+            print(f"  {name}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Generators of synthetic StepMania charts and Beat Saber maps for the benchmarks."""
+import random
+import sys
+from io import StringIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "steps2blocks"))
+
+from bsmap import BeatMap, BPMInfo, DifficultyBeatmap, DifficultyBeatmapSet, Difficulty, ColorNote, BombNote, \
+    BasicEvent, BPMEvent, NoteColor, CutDirection  # noqa: E402
+
+ROW_DENSITIES = (4, 8, 12, 16, 24, 32, 48, 64, 96, 192)
+SM_DIFFICULTIES = ("Beginner", "Easy", "Medium", "Hard", "Challenge")
+BS_DIFFICULTIES = tuple(Difficulty)
+
+
+def _bpm_changes(rng: random.Random, count: int, beats: float) -> list[tuple[float, float]]:
+    changes = [(0.0, 150.0)]
+    for i in range(1, count + 1):
+        changes.append((round(beats * i / (count + 1), 3), float(rng.randrange(60, 300))))
+    return changes
+
+
+def synthetic_sm(
+        measures: int,
+        charts: int = 1,
+        seed: int = 0,
+        densities: tuple[int, ...] = (4, 8, 16, 24, 32),
+        bpm_changes: int = 0,
+        note_rate: float = 0.2,
+        mine_rate: float = 0.05,
+        hold_rate: float = 0.0
+) -> str:
+    """A .sm file with `charts` dance-single charts of `measures` measures each.
+
+    Every measure gets a row density picked from `densities` (4ths through 192nds).
+    Each column of a row holds a note, mine or hold/roll head with the given chances;
+    holds and rolls end between 1 and 8 rows later.
+    """
+    rng = random.Random(seed)
+    out = StringIO()
+    out.write("#TITLE:Synthetic \\#1;\n#ARTIST:bench;\n#MUSIC:song.ogg;\n#OFFSET:-0.010;\n")
+    bpms = ",".join(f"{beat:.3f}={bpm:.3f}" for beat, bpm in _bpm_changes(rng, bpm_changes, measures * 4))
+    out.write(f"#BPMS:{bpms};\n")
+
+    for chart in range(charts):
+        out.write(f"//---------------dance-single - chart {chart}----------------\n")
+        out.write(f"#NOTES:\n     dance-single:\n     :\n     {SM_DIFFICULTIES[chart % len(SM_DIFFICULTIES)]}:\n"
+                  f"     9:\n     0,0,0,0,0:\n")
+        hold_rows_left = [0] * 4
+        for measure in range(measures):
+            for _ in range(rng.choice(densities)):
+                row = []
+                for column in range(4):
+                    if hold_rows_left[column]:
+                        hold_rows_left[column] -= 1
+                        row.append("3" if not hold_rows_left[column] else "0")
+                        continue
+                    r = rng.random()
+                    if r < hold_rate:
+                        hold_rows_left[column] = rng.randint(1, 8)
+                        row.append(rng.choice("24"))
+                    elif r < hold_rate + mine_rate:
+                        row.append("M")
+                    elif r < hold_rate + mine_rate + note_rate:
+                        row.append("1")
+                    else:
+                        row.append("0")
+                out.write("".join(row))
+                out.write("\n")
+            if measure + 1 == measures:
+                break
+            out.write(f",  // measure {measure + 1}\n")
+        # close holds that are still open in an extra row
+        if any(hold_rows_left):
+            out.write(",\n" + "".join("3" if rows else "0" for rows in hold_rows_left) + "\n")
+        out.write(";\n")
+    return out.getvalue()
+
+
+def synthetic_difficulty(notes: int, seed: int = 0) -> DifficultyBeatmap:
+    rng = random.Random(seed)
+    dm = DifficultyBeatmap(version="3.0.0")
+    dm.bpm_events.append(BPMEvent(0.0, 150.0))
+    for i in range(notes):
+        beat = i / 4
+        dm.color_notes.append(ColorNote(beat, rng.randrange(4), rng.randrange(3),
+                                        rng.choice(list(NoteColor)), rng.choice(list(CutDirection))))
+        if i % 8 == 0:
+            dm.bomb_notes.append(BombNote(beat + 0.125, rng.randrange(4), 0))
+        if i % 2 == 0:
+            dm.basic_events.append(BasicEvent(beat, rng.randrange(5), rng.randrange(8), 1.0))
+    return dm
+
+
+def synthetic_beatmap(notes: int, difficulties: int = 1, bpm_changes: int = 0, seed: int = 0) -> BeatMap:
+    """A v3 map with `difficulties` difficulties of `notes` color notes each, plus bombs and lighting events."""
+    rng = random.Random(seed)
+    bm = BeatMap(version="2.0.0", song_name="Synthetic", song_author_name="bench", song_filename="song.ogg",
+                 beats_per_minute=150.0)
+    bpm_events = [BPMEvent(beat, bpm) for beat, bpm in _bpm_changes(rng, bpm_changes, notes / 4)]
+
+    diff_set = DifficultyBeatmapSet()
+    for i in range(difficulties):
+        dm = synthetic_difficulty(notes, seed + i)
+        dm.difficulty = BS_DIFFICULTIES[i % len(BS_DIFFICULTIES)]
+        dm.filename = f"{dm.difficulty.difficulty}{diff_set.characteristic.value}.dat"
+        dm.bpm_events = bpm_events[:]
+        diff_set.diff_maps.append(dm)
+    bm.difficulty_beatmap_sets.append(diff_set)
+
+    if len(bpm_events) > 1:
+        bm.bpm_info = BPMInfo()
+        bm.bpm_info.load_regions_from_events(bpm_events)
+    return bm
@@ -1,7 +1,247 @@
-import gui
+import argparse
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Optional
 
+from convert import HoldPolicy
+from smmap import Difficulty
 
-def main():
+
+def add_conversion_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--sample-rate", type=int, default=44100,
+                        help="song sample rate in Hz, used when the audio can't be probed")
+    parser.add_argument("--song-length", type=int, default=600,
+                        help="song length in seconds, used when the audio can't be probed")
+    parser.add_argument("--no-probe", action="store_true",
+                        help="don't read the sample rate and length from the song's audio file")
+    parser.add_argument("--holds", choices=[policy.value for policy in HoldPolicy],
+                        default=HoldPolicy.HEAD_NOTE.value,
+                        help="what holds and rolls turn into: nothing, a note where they start, a note with an "
+                             "arc to where they end or a burst slider (default: head)")
+    parser.add_argument("--encoding",
+                        help="text encoding of the .sm/.ssc files (default: UTF-8, falling back to Shift-JIS "
+                             "and then Latin-1)")
+
+
+def conversion_settings(args: argparse.Namespace, zip_output: bool = False):
+    import batch
+    return batch.ConversionSettings(args.sample_rate, args.song_length, HoldPolicy(args.holds), not args.no_probe,
+                                    zip_output, args.encoding)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="steps2blocks",
+        description="Convert stepmania charts to Beat Saber maps. Opens the GUI when no command is given."
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    batch_parser = commands.add_parser("batch", help="convert every .sm/.ssc file in one or more directories")
+    batch_parser.add_argument("inputs", nargs="*", type=Path, help="song pack directories or .sm/.ssc files")
+    batch_parser.add_argument("--files-from", type=argparse.FileType("rt", encoding="utf-8"), metavar="FILE",
+                              help="also convert the .sm/.ssc files listed in FILE, one per line, or - for stdin, "
+                                   "e.g. the output of query")
+    batch_parser.add_argument("-o", "--output", required=True, type=Path, help="directory to write the maps to")
+    batch_parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                              help="number of worker processes (default: number of CPUs)")
+    add_conversion_arguments(batch_parser)
+    batch_parser.add_argument("--zip", action="store_true",
+                              help="write every song, audio included, to a .zip file instead of a directory")
+    batch_parser.add_argument("--cache", type=Path,
+                              help="directory of a conversion cache, unchanged songs are restored from it")
+    batch_parser.add_argument("--cache-size", type=int, default=1024,
+                              help="size bound of the conversion cache in MiB (default: 1024)")
+    batch_parser.add_argument("--audio-store", type=Path,
+                              help="directory to keep every distinct audio file in once, outputs link to it")
+    batch_parser.add_argument("--profile-report", type=Path, metavar="FILE",
+                              help="write the time and memory spent per conversion stage to a JSON file")
+    batch_parser.add_argument("-v", "--verbose", action="store_true",
+                              help="show a summary of the conversion warnings of every song")
+
+    watch_parser = commands.add_parser(
+        "watch", help="convert .sm/.ssc files and convert the charts that changed again whenever they're saved"
+    )
+    watch_parser.add_argument("inputs", nargs="+", type=Path, help="song directories or .sm/.ssc files")
+    watch_parser.add_argument("-o", "--output", required=True, type=Path, help="directory to write the maps to")
+    add_conversion_arguments(watch_parser)
+    watch_parser.add_argument("--interval", type=float, default=0.1,
+                              help="seconds between checks of the files for changes (default: 0.1)")
+
+    index_parser = commands.add_parser("index", help="add the songs in song folders to a library index, or update them")
+    index_parser.add_argument("library", type=Path, help="the library's database file, created if it doesn't exist")
+    index_parser.add_argument("roots", nargs="+", type=Path, help="song folders to index")
+    index_parser.add_argument("--encoding",
+                              help="text encoding of the .sm/.ssc files (default: UTF-8, falling back to Shift-JIS "
+                                   "and then Latin-1)")
+
+    query_parser = commands.add_parser("query", help="list the songs in a library index that match every condition")
+    query_parser.add_argument("library", type=Path, help="the library's database file, made by index")
+    query_parser.add_argument("--title", help="part of the title or subtitle, case-insensitive")
+    query_parser.add_argument("--artist", help="part of the artist, case-insensitive")
+    query_parser.add_argument("--min-bpm", type=float, help="lowest BPM of the song")
+    query_parser.add_argument("--max-bpm", type=float, help="highest BPM of the song")
+    query_parser.add_argument("--chart-type", help="chart type of one of the song's charts, e.g. dance-single")
+    query_parser.add_argument("--difficulty", choices=[difficulty.value for difficulty in Difficulty],
+                              help="difficulty of one of the song's charts")
+    query_parser.add_argument("--min-meter", type=int, help="lowest meter of that chart")
+    query_parser.add_argument("--max-meter", type=int, help="highest meter of that chart")
+
+    serve_parser = commands.add_parser("serve", help="run a local HTTP service that converts songs on request")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    serve_parser.add_argument("--port", type=int, default=8000, help="port to listen on (default: 8000)")
+    serve_parser.add_argument("--unix", type=Path, metavar="PATH", help="listen on a Unix socket at PATH instead")
+    serve_parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                              help="number of worker processes, and of conversions run at once "
+                                   "(default: number of CPUs)")
+    serve_parser.add_argument("--max-queue", type=int, default=16,
+                              help="conversions that may wait for a worker, more are turned away with a 503 "
+                                   "(default: 16)")
+    add_conversion_arguments(serve_parser)
+    serve_parser.add_argument("--zip", action="store_true",
+                              help="write songs converted to an output directory to a .zip file instead")
+
+    return parser
+
+
+def run_batch_command(args: argparse.Namespace) -> int:
+    import batch
+
+    inputs = list(args.inputs)
+    if args.files_from is not None:
+        with args.files_from:
+            inputs.extend(Path(line.rstrip("\n")) for line in args.files_from if line.strip())
+    try:
+        jobs = batch.find_jobs(inputs, args.output)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if not jobs:
+        print("No .sm or .ssc files found", file=sys.stderr)
+        return 1
+
+    start = time.perf_counter()
+    results = []
+    for result in batch.run_batch(
+            jobs,
+            args.workers,
+            conversion_settings(args, args.zip),
+            logging.WARNING if args.verbose else logging.ERROR,
+            args.cache,
+            args.audio_store,
+            args.profile_report is not None
+    ):
+        results.append(result)
+        if result.error is not None:
+            print(f"FAILED {result.job.sm_path}: {result.error}", file=sys.stderr)
+        if args.verbose and result.warnings:
+            print(f"{result.job.sm_path}:", file=sys.stderr)
+            for warning in result.warnings:
+                print(f"  {warning}", file=sys.stderr)
+    batch.print_summary(results, time.perf_counter() - start, sys.stdout)
+
+    if args.profile_report is not None:
+        import instrument
+        profile = instrument.merge([result.profile for result in results if result.profile is not None])
+        with args.profile_report.open("wt", encoding="utf-8") as f:
+            instrument.write_report(f, profile)
+        instrument.print_report(sys.stdout, profile)
+
+    if args.cache is not None:
+        from cache import ConversionCache
+        ConversionCache(args.cache, args.cache_size << 20).evict()
+
+    return 0 if all(result.error is None for result in results) else 2
+
+
+def run_watch_command(args: argparse.Namespace) -> int:
+    import batch
+    import watch
+
+    try:
+        jobs = batch.find_jobs(args.inputs, args.output)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if not jobs:
+        print("No .sm or .ssc files found", file=sys.stderr)
+        return 1
+
+    def report(result: watch.UpdateResult):
+        if result.error is not None:
+            print(f"FAILED {result.job.sm_path}: {result.error}", file=sys.stderr)
+            return
+        print(f"{result.job.sm_path}: converted {result.converted}/{result.total} charts, "
+              f"wrote {', '.join(result.written)} in {result.elapsed * 1000:.1f}ms", flush=True)
+        for warning in result.warnings:
+            print(f"  {warning}", file=sys.stderr)
+
+    print(f"Watching {len(jobs)} songs, press Ctrl+C to stop", flush=True)
+    try:
+        watch.watch(jobs, conversion_settings(args), report, args.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def run_index_command(args: argparse.Namespace) -> int:
+    from library import Library
+
+    start = time.perf_counter()
+    with Library(args.library, args.encoding) as library:
+        stats = library.index(args.roots)
+    print(f"Indexed in {time.perf_counter() - start:.2f}s: {stats.added} added, {stats.updated} updated, "
+          f"{stats.unchanged} unchanged, {stats.removed} removed, {stats.failed} failed")
+    return 0 if not stats.failed else 2
+
+
+def run_query_command(args: argparse.Namespace) -> int:
+    import sqlite3
+    from library import Library
+
+    try:
+        with Library(args.library, create=False) as library:
+            paths = library.query(args.title, args.artist, args.min_bpm, args.max_bpm, args.chart_type,
+                                  args.difficulty, args.min_meter, args.max_meter)
+    except sqlite3.Error as e:
+        print(f"Could not read the library {args.library}: {e}", file=sys.stderr)
+        return 2
+    for path in paths:
+        print(path)
+    return 0 if paths else 1
+
+
+def run_serve_command(args: argparse.Namespace) -> int:
+    import asyncio
+    from service import ConversionService
+
+    service = ConversionService(conversion_settings(args, args.zip), args.workers or 1, args.max_queue)
+    where = args.unix if args.unix is not None else f"http://{args.host}:{args.port}"
+    print(f"Serving on {where}, press Ctrl+C to stop", flush=True)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main(argv: Optional[list[str]] = None):
+    args = build_parser().parse_args(argv)
+
+    if args.command == "batch":
+        sys.exit(run_batch_command(args))
+    if args.command == "watch":
+        sys.exit(run_watch_command(args))
+    if args.command == "index":
+        sys.exit(run_index_command(args))
+    if args.command == "query":
+        sys.exit(run_query_command(args))
+    if args.command == "serve":
+        sys.exit(run_serve_command(args))
+
+    import gui
     gui.open_gui()
 
 
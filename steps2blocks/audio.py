@@ -0,0 +1,146 @@
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from typing import Optional, Union
+
+from filehash import file_digest
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# from linux/fs.h, clones a whole file on filesystems that support it (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+_CHUNK_SIZE = 1 << 20
+
+
+def _reflink(src: Path, dst: Path):
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError("reflinks are not supported on this platform")
+    with src.open("rb") as src_file, dst.open("xb") as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            dst.unlink()
+            raise
+    shutil.copystat(src, dst)
+
+
+def _kernel_copy(src: Path, dst: Path):
+    """Copy without moving the data through Python, with copy_file_range or sendfile."""
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if copy_file_range is None and not sys.platform.startswith("linux"):
+        # sendfile only takes a regular file as its output on linux
+        raise OSError("in-kernel copies are not supported on this platform")
+
+    with src.open("rb") as src_file, dst.open("xb") as dst_file:
+        try:
+            remaining = os.fstat(src_file.fileno()).st_size
+            offset = 0
+            while remaining > 0:
+                if copy_file_range is not None:
+                    copied = copy_file_range(src_file.fileno(), dst_file.fileno(), remaining)
+                else:
+                    copied = os.sendfile(dst_file.fileno(), src_file.fileno(), offset, remaining)
+                if copied == 0:
+                    break
+                offset += copied
+                remaining -= copied
+        except OSError:
+            dst_file.close()
+            dst.unlink()
+            raise
+    shutil.copystat(src, dst)
+
+
+def _chunked_copy(src: Path, dst: Path):
+    with src.open("rb") as src_file, dst.open("xb") as dst_file:
+        shutil.copyfileobj(src_file, dst_file, _CHUNK_SIZE)
+    shutil.copystat(src, dst)
+
+
+def place_file(src: Union[str, Path], dst: Union[str, Path], allow_hardlink: bool = True) -> str:
+    """Make `dst` a copy of `src` as cheaply as the filesystem allows.
+
+    Tries, in order, a hardlink, a reflink, an in-kernel copy and finally a plain
+    chunked copy. A hardlink shares the file with `src`, so only allow it for files
+    that are never modified in place. Returns the method that worked.
+    """
+    src, dst = Path(src), Path(dst)
+    if allow_hardlink:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    try:
+        _reflink(src, dst)
+        return "reflink"
+    except OSError:
+        pass
+    try:
+        _kernel_copy(src, dst)
+        return "kernel copy"
+    except OSError:
+        pass
+    _chunked_copy(src, dst)
+    return "copy"
+
+
+class AudioStore:
+    """Content addressed store of audio files, so identical audio is only kept once.
+
+    Files are stored by the hash of their contents and are never modified, so outputs
+    can be hardlinked to them. Files are added to a temporary name first and moved
+    into place, so several processes can share one store.
+    """
+
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
+        # path -> (size, mtime, stored path), to avoid hashing the same file twice
+        self._known: dict[Path, tuple[int, int, Path]] = {}
+
+    def add(self, path: Union[str, Path]) -> Path:
+        """Add a file to the store if it isn't in there yet, returns the stored file."""
+        path = Path(path)
+        stat = path.stat()
+        known = self._known.get(path)
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+            return known[2]
+
+        digest = file_digest(path)
+        stored_path = self.root / digest[:2] / f"{digest}{path.suffix.lower()}"
+        if not stored_path.is_file():
+            stored_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(prefix=f".{digest}.", dir=stored_path.parent)
+            os.close(fd)
+            tmp_path = Path(tmp_name)
+            try:
+                tmp_path.unlink()
+                # the source may be modified later on, so the store needs its own copy
+                place_file(path, tmp_path, allow_hardlink=False)
+                os.replace(tmp_path, stored_path)
+            finally:
+                if tmp_path.exists():
+                    tmp_path.unlink()
+
+        self._known[path] = (stat.st_size, stat.st_mtime_ns, stored_path)
+        return stored_path
+
+
+def place_audio(src: Union[str, Path], dst: Union[str, Path], store: Optional[AudioStore] = None) -> Optional[str]:
+    """Put a song's audio at `dst`, unless there's a file there already.
+
+    Without a store the audio is never hardlinked to `src`, as that would tie the
+    output to the original song. With one it's added to the store and `dst` is
+    linked to the stored file. Returns how it was placed, or None if it already was.
+    """
+    if os.path.exists(dst):
+        return None
+    if store is None:
+        return place_file(src, dst, allow_hardlink=False)
+    return place_file(store.add(src), dst)
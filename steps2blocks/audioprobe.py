@@ -0,0 +1,192 @@
+import logging
+import os
+import struct
+from pathlib import Path
+from typing import BinaryIO, NamedTuple, Union
+
+# the largest possible ogg page is a little under 64 KiB
+_OGG_TAIL_SIZE = 65536 + 512
+_MP3_SYNC_SEARCH_SIZE = 65536
+
+_MP3_BITRATES = {
+    # (MPEG 1, layer): kbps by index
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+class AudioInfo(NamedTuple):
+    sample_rate: int
+    sample_count: int
+
+    @property
+    def duration(self) -> float:
+        return self.sample_count / self.sample_rate
+
+
+def probe_audio(path: Union[str, Path]) -> AudioInfo:
+    """Get the sample rate and length of an OGG Vorbis, WAV or MP3 file.
+
+    Only the container headers are read, never the audio itself. Lengths are
+    exact, except for constant bitrate MP3 files without a Xing/Info or VBRI
+    header, where the length is worked out from the file size.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(12)
+        f.seek(0)
+        if magic[:4] == b"OggS":
+            return _probe_ogg(f)
+        if magic[:4] == b"RIFF" and magic[8:12] == b"WAVE":
+            return _probe_wav(f)
+        if magic[:3] == b"ID3" or (len(magic) >= 2 and magic[0] == 0xFF and magic[1] & 0xE0 == 0xE0):
+            return _probe_mp3(f)
+    raise ValueError(f"Unsupported audio format: {path}")
+
+
+def _probe_wav(f: BinaryIO) -> AudioInfo:
+    f.seek(12)
+    sample_rate = block_align = None
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            raise ValueError("WAV file has no data chunk")
+        chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+        if chunk_id == b"fmt ":
+            _, _, sample_rate, _, block_align = struct.unpack("<HHIIH", f.read(14))
+            if sample_rate == 0 or block_align == 0:
+                raise ValueError("WAV format chunk has no sample rate or block size")
+            f.seek(chunk_size - 14 + (chunk_size & 1), os.SEEK_CUR)
+        elif chunk_id == b"data":
+            if sample_rate is None:
+                raise ValueError("WAV data chunk comes before its format chunk")
+            data_size = chunk_size
+            remaining = os.fstat(f.fileno()).st_size - f.tell()
+            if data_size == 0xFFFFFFFF or data_size > remaining:
+                # streamed or truncated files don't have a correct data size
+                data_size = remaining
+            return AudioInfo(sample_rate, data_size // block_align)
+        else:
+            f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+def _probe_ogg(f: BinaryIO) -> AudioInfo:
+    header = f.read(27)
+    serial = struct.unpack_from("<I", header, 14)[0]
+    segment_count = header[26]
+    packet = f.read(segment_count + 30)[segment_count:]
+    if packet[:7] != b"\x01vorbis":
+        raise ValueError("Only Vorbis streams are supported in OGG files")
+    sample_rate = struct.unpack_from("<I", packet, 12)[0]
+    if sample_rate == 0:
+        raise ValueError("Vorbis stream has no sample rate")
+
+    # the granule position of the last page of the stream is its length in samples
+    size = os.fstat(f.fileno()).st_size
+    f.seek(max(0, size - _OGG_TAIL_SIZE))
+    tail = f.read()
+    idx = len(tail)
+    while True:
+        idx = tail.rfind(b"OggS", 0, idx)
+        if idx == -1:
+            raise ValueError("Could not find the last page of the OGG stream")
+        if idx + 27 > len(tail):
+            # "OggS" in the data of a page, too close to the end to be a page header
+            continue
+        granule, page_serial = struct.unpack_from("<qI", tail, idx + 6)
+        if page_serial == serial and granule >= 0:
+            return AudioInfo(sample_rate, granule)
+
+
+def _mp3_frame_header(data: bytes, idx: int):
+    """Parse the MPEG audio frame header at `idx`, returns None if there isn't a valid one."""
+    if idx + 4 > len(data) or data[idx] != 0xFF or data[idx + 1] & 0xE0 != 0xE0:
+        return None
+    version = (data[idx + 1] >> 3) & 0x3
+    layer = 4 - ((data[idx + 1] >> 1) & 0x3)
+    bitrate_idx = data[idx + 2] >> 4
+    rate_idx = (data[idx + 2] >> 2) & 0x3
+    if version == 1 or layer == 4 or bitrate_idx in (0, 15) or rate_idx == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[(mpeg1, layer)][bitrate_idx] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_idx]
+    padding = (data[idx + 2] >> 1) & 0x1
+    mono = data[idx + 3] >> 6 == 3
+    if layer == 1:
+        samples_per_frame = 384
+        frame_size = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples_per_frame = 1152 if mpeg1 or layer == 2 else 576
+        frame_size = samples_per_frame // 8 * bitrate // sample_rate + padding
+    return mpeg1, layer, mono, bitrate, sample_rate, samples_per_frame, frame_size
+
+
+def _probe_mp3(f: BinaryIO) -> AudioInfo:
+    start = 0
+    id3_header = f.read(10)
+    if id3_header[:3] == b"ID3":
+        size = 0
+        for b in id3_header[6:10]:
+            size = (size << 7) | (b & 0x7F)
+        start = 10 + size + (10 if id3_header[5] & 0x10 else 0)
+
+    f.seek(start)
+    data = f.read(_MP3_SYNC_SEARCH_SIZE)
+    idx = 0
+    while True:
+        idx = data.find(b"\xFF", idx)
+        if idx == -1:
+            raise ValueError("Could not find an MPEG audio frame")
+        header = _mp3_frame_header(data, idx)
+        # make sure it's not a stray sync pattern by checking the next frame as well
+        if header is not None and (idx + header[6] + 4 > len(data)
+                                   or _mp3_frame_header(data, idx + header[6]) is not None):
+            break
+        idx += 1
+    mpeg1, layer, mono, bitrate, sample_rate, samples_per_frame, frame_size = header
+
+    if layer == 3:
+        xing_idx = idx + 4 + ((17 if mono else 32) if mpeg1 else (9 if mono else 17))
+        if data[xing_idx:xing_idx + 4] in (b"Xing", b"Info"):
+            flags = struct.unpack_from(">I", data, xing_idx + 4)[0]
+            if flags & 0x1:
+                frames = struct.unpack_from(">I", data, xing_idx + 8)[0]
+                sample_count = frames * samples_per_frame
+                # LAME stores the encoder delay and padding right after the Xing header
+                lame_idx = xing_idx + 8
+                for flag, size in ((0x1, 4), (0x2, 4), (0x4, 100), (0x8, 4)):
+                    if flags & flag:
+                        lame_idx += size
+                if data[lame_idx:lame_idx + 4] in (b"LAME", b"Lavf", b"Lavc"):
+                    delay_padding = data[lame_idx + 21:lame_idx + 24]
+                    if len(delay_padding) == 3:
+                        delay = (delay_padding[0] << 4) | (delay_padding[1] >> 4)
+                        padding = ((delay_padding[1] & 0xF) << 8) | delay_padding[2]
+                        sample_count -= delay + padding
+                return AudioInfo(sample_rate, sample_count)
+
+        vbri_idx = idx + 36
+        if data[vbri_idx:vbri_idx + 4] == b"VBRI":
+            frames = struct.unpack_from(">I", data, vbri_idx + 14)[0]
+            return AudioInfo(sample_rate, frames * samples_per_frame)
+
+    # constant bitrate without a header telling us the length, estimate from the file size
+    file_size = os.fstat(f.fileno()).st_size
+    f.seek(max(0, file_size - 128))
+    audio_size = file_size - start - idx - (128 if f.read(3) == b"TAG" else 0)
+    return AudioInfo(sample_rate, int(audio_size * 8 * sample_rate / bitrate))
+
+
+def probe_song_audio(audio_path: Union[str, Path], fallback: AudioInfo) -> AudioInfo:
+    """Probe a song's audio file, returning `fallback` with a warning if it's missing or can't be read."""
+    try:
+        return probe_audio(audio_path)
+    except (OSError, ValueError, struct.error) as e:
+        logging.warning(f"Could not read the length of {audio_path}, using {fallback.duration:.0f}s instead: {e}")
+        return fallback
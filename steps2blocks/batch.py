@@ -0,0 +1,277 @@
+import logging
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Iterable, Iterator, NamedTuple, Optional, TextIO
+
+from audio import AudioStore, place_audio
+from audioprobe import AudioInfo, probe_song_audio
+import instrument
+from cache import ConversionCache
+from diagnostics import Diagnostics
+from convert import beatmap_from_sm, HoldPolicy
+from smmap import load_song
+
+STAGES = ("cache", "load", "convert", "save", "audio")
+# name of the zip in a conversion cache entry
+_CACHED_ZIP_NAME = "map.zip"
+
+
+class BatchJob(NamedTuple):
+    sm_path: Path
+    output_path: Path
+
+
+class ConversionSettings(NamedTuple):
+    # only used when the song's audio can't be probed, unless probe_audio is off
+    sample_rate: int = 44100
+    song_length: int = 600  # seconds
+    hold_policy: HoldPolicy = HoldPolicy.HEAD_NOTE
+    probe_audio: bool = True
+    zip_output: bool = False  # write each song to a .zip next to where its directory would be
+    encoding: Optional[str] = None  # of the .sm/.ssc metadata, detected if not set
+
+    def cache_params(self) -> dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "song_length": self.song_length,
+            "hold_policy": self.hold_policy.value,
+            "probe_audio": self.probe_audio,
+            "zip_output": self.zip_output,
+            "encoding": self.encoding
+        }
+
+    def audio_info(self, audio_path: Optional[Path]) -> AudioInfo:
+        fallback = AudioInfo(self.sample_rate, self.song_length * self.sample_rate)
+        if not self.probe_audio or audio_path is None:
+            return fallback
+        return probe_song_audio(audio_path, fallback)
+
+
+class SongResult(NamedTuple):
+    job: BatchJob
+    stage_times: dict[str, float]
+    error: Optional[str] = None
+    cached: bool = False
+    profile: Optional[dict[str, Any]] = None  # instrument snapshot, if instrumentation is enabled
+    warnings: tuple[str, ...] = ()  # one summary of the problems found per chart
+
+
+def _song_files(directory: Path) -> list[Path]:
+    """Every .sm and .ssc file under `directory`, whatever the case of their extension.
+
+    Same as StepMania, a .sm file is left out if there's a .ssc file with the same name next to it.
+    """
+    found = sorted(path for path in directory.rglob("*")
+                   if path.suffix.lower() in (".sm", ".ssc") and path.is_file())
+    ssc_stems = {(path.parent, path.stem) for path in found if path.suffix.lower() == ".ssc"}
+    return [path for path in found if path.suffix.lower() == ".ssc" or (path.parent, path.stem) not in ssc_stems]
+
+
+def find_jobs(inputs: Iterable[Path], output_root: Path) -> list[BatchJob]:
+    """Find every .sm or .ssc file under the given directories (or the files themselves) and where to put its map.
+
+    Maps go to the output root under the name of the input directory they were found in,
+    keeping the folder layout below it; a file given on its own goes under the names of its
+    pack and song folders. A song folder with several charts gets a map per chart, named
+    after the folder and the chart. Raises ValueError if two maps would still end up in the
+    same place, e.g. for packs with the same name.
+    """
+    songs = []
+    for input_path in inputs:
+        if input_path.is_dir():
+            pack_dir = Path(input_path.resolve().name)
+            songs.extend((sm_path, pack_dir / sm_path.parent.relative_to(input_path))
+                         for sm_path in _song_files(input_path))
+        else:
+            song_dir = input_path.resolve().parent
+            songs.append((input_path, Path(song_dir.parent.name, song_dir.name)))
+
+    # the same file given twice, e.g. in a directory and on its own, is converted once
+    songs = list({sm_path.resolve(): (sm_path, song_dir) for sm_path, song_dir in reversed(songs)}.values())[::-1]
+    charts_per_dir = Counter(sm_path.resolve().parent for sm_path, _ in songs)
+    jobs = []
+    for sm_path, song_dir in songs:
+        if charts_per_dir[sm_path.resolve().parent] > 1:
+            song_dir = song_dir.with_name(f"{song_dir.name} - {sm_path.stem}")
+        jobs.append(BatchJob(sm_path, output_root / song_dir))
+
+    sources = {}
+    for job in jobs:
+        other = sources.setdefault(job.output_path, job.sm_path)
+        if other != job.sm_path:
+            raise ValueError(f"{other} and {job.sm_path} would both be converted to {job.output_path}")
+    return jobs
+
+
+def _audio_stat(job: BatchJob, music_path: str) -> Optional[list[int]]:
+    """Size and mtime of the song's audio, a cached conversion is only valid while these don't change."""
+    if not music_path:
+        return None
+    try:
+        stat = (job.sm_path.parent / music_path).stat()
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _audio_path(job: BatchJob, music_path: str) -> Optional[Path]:
+    audio_path = job.sm_path.parent / music_path
+    if music_path and audio_path.is_file():
+        return audio_path
+    return None
+
+
+# one per store root and process, so each worker remembers which files it already hashed
+_audio_stores: dict[Path, AudioStore] = {}
+
+
+def _copy_audio(job: BatchJob, music_path: str, song_filename: str, audio_store_root: Optional[Path] = None):
+    audio_path = _audio_path(job, music_path)
+    if audio_path is not None:
+        store = None
+        if audio_store_root is not None:
+            store = _audio_stores.setdefault(audio_store_root, AudioStore(audio_store_root))
+        place_audio(audio_path, job.output_path / song_filename, store)
+
+
+def convert_song(
+        job: BatchJob,
+        settings: ConversionSettings,
+        cache_root: Optional[Path] = None,
+        audio_store_root: Optional[Path] = None
+) -> SongResult:
+    """Convert a single song, never raising: failures are reported in the result."""
+    stage_times = {}
+    stage = "cache" if cache_root is not None else "load"
+    stage_start = time.perf_counter()
+
+    def next_stage(name: str):
+        nonlocal stage, stage_start
+        now = time.perf_counter()
+        stage_times[stage] = now - stage_start
+        stage, stage_start = name, now
+
+    # in zip mode the cache entry is the zip file alone, kept under a name of its own so any song can restore it
+    zip_path = job.output_path.with_name(f"{job.output_path.name}.zip")
+    output_dir = zip_path.parent if settings.zip_output else job.output_path
+    renames = {_CACHED_ZIP_NAME: zip_path.name} if settings.zip_output else None
+
+    try:
+        cache = cache_key = None
+        if cache_root is not None:
+            cache = ConversionCache(cache_root)
+            cache_params = settings.cache_params()
+            if settings.probe_audio or settings.zip_output:
+                # the audio goes into the map, by its length or as a file in the zip, so a new one needs a new entry
+                music_path = load_song(str(job.sm_path), lazy=True, diagnostics=Diagnostics(),
+                                       encoding=settings.encoding).music_path
+                cache_params["audio_stat"] = _audio_stat(job, music_path)
+            cache_key = cache.key(job.sm_path, **cache_params)
+            cached = cache.restore(cache_key, output_dir, renames)
+            if cached is not None:
+                if not settings.zip_output:
+                    next_stage("audio")
+                    _copy_audio(job, cached["music_path"], cached["song_filename"], audio_store_root)
+                next_stage("")
+                return SongResult(job, stage_times, cached=True, profile=_take_profile())
+            next_stage("load")
+
+        diagnostics = Diagnostics()
+        sm_song = load_song(str(job.sm_path), diagnostics=diagnostics, encoding=settings.encoding)
+        next_stage("convert")
+        audio_info = settings.audio_info(job.sm_path.parent / sm_song.music_path if sm_song.music_path else None)
+        bs_song = beatmap_from_sm(sm_song, audio_info.sample_count, audio_info.sample_rate, settings.hold_policy,
+                                  diagnostics=diagnostics)
+        next_stage("save")
+        job.output_path.parent.mkdir(parents=True, exist_ok=True)
+        if settings.zip_output:
+            bs_song.save_to_zip(zip_path, _audio_path(job, sm_song.music_path))
+            filenames = [_CACHED_ZIP_NAME]
+        else:
+            bs_song.save_to_disk(job.output_path)
+            filenames = bs_song.filenames()
+        if cache is not None:
+            cache.store(cache_key, output_dir, filenames, {
+                "music_path": sm_song.music_path,
+                "song_filename": bs_song.song_filename
+            }, renames)
+        if not settings.zip_output:
+            next_stage("audio")
+            _copy_audio(job, sm_song.music_path, bs_song.song_filename, audio_store_root)
+        next_stage("")
+    except Exception as e:
+        failed_stage = stage
+        next_stage("")
+        return SongResult(job, stage_times, f"{failed_stage}: {type(e).__name__}: {e}", profile=_take_profile())
+
+    return SongResult(job, stage_times, profile=_take_profile(), warnings=tuple(diagnostics.summaries()))
+
+
+def _take_profile() -> Optional[dict[str, Any]]:
+    return instrument.snapshot(reset=True) if instrument.is_enabled() else None
+
+
+def _init_worker(log_level: int, profile: bool = False):
+    logging.getLogger().setLevel(log_level)
+    if profile:
+        instrument.enable()
+
+
+def run_batch(
+        jobs: list[BatchJob],
+        workers: Optional[int] = None,
+        settings: ConversionSettings = ConversionSettings(),
+        log_level: int = logging.ERROR,
+        cache_root: Optional[Path] = None,
+        audio_store_root: Optional[Path] = None,
+        profile: bool = False
+) -> Iterator[SongResult]:
+    """Convert all jobs, yielding results as songs finish.
+
+    With a single worker everything runs in this process, otherwise songs are spread over a process pool.
+    Songs found in the conversion cache at `cache_root` are restored instead of converted.
+    With an `audio_store_root`, identical audio is stored once there and linked into the outputs.
+    With `profile` set, every result carries the instrument snapshot of its conversion.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        _init_worker(log_level, profile)
+        try:
+            for job in jobs:
+                yield convert_song(job, settings, cache_root, audio_store_root)
+        finally:
+            if profile:
+                instrument.disable()
+        return
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(log_level, profile)) as executor:
+        futures = [executor.submit(convert_song, job, settings, cache_root, audio_store_root) for job in jobs]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def print_summary(results: list[SongResult], elapsed: float, out: TextIO):
+    failures = [result for result in results if result.error is not None]
+    converted = len(results) - len(failures)
+    cached = sum(result.cached for result in results)
+
+    print(f"Converted {converted}/{len(results)} songs in {elapsed:.2f}s "
+          f"({len(results) / elapsed if elapsed > 0 else 0.0:.1f} songs/s)", file=out)
+    if cached:
+        print(f"  {cached} restored from the conversion cache", file=out)
+    with_warnings = sum(bool(result.warnings) for result in results)
+    if with_warnings:
+        print(f"  {with_warnings} with warnings", file=out)
+
+    for stage in STAGES:
+        times = [result.stage_times[stage] for result in results if stage in result.stage_times]
+        if times:
+            print(f"  {stage:<8} total {sum(times):8.2f}s  mean {sum(times) / len(times) * 1000:8.1f}ms", file=out)
+
+    if failures:
+        print(f"{len(failures)} failed:", file=out)
+        for result in failures:
+            print(f"  {result.job.sm_path}: {result.error}", file=out)
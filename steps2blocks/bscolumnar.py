@@ -0,0 +1,164 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from enum import Enum
+from operator import attrgetter
+from typing import Any, Iterable, NamedTuple
+
+from bsmap import DifficultyBeatmap, V3_OBJECT_SCHEMAS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# (array typecode, numpy dtype) per field annotation, enums are stored by value
+_COLUMN_TYPES = {
+    float: ("d", "float64"),
+    int: ("q", "int64"),
+    bool: ("b", "bool"),
+}
+
+
+def _column_type(annotation: Any) -> tuple[str, str]:
+    if isinstance(annotation, type) and issubclass(annotation, Enum):
+        return _COLUMN_TYPES[int]
+    return _COLUMN_TYPES[annotation]
+
+
+class ObjectColumns:
+    """Beat-sorted parallel arrays holding every object of one kind.
+
+    Columns are NumPy arrays when NumPy is installed and `array.array`s otherwise.
+    Enum fields are stored by their value.
+    """
+
+    def __init__(self, object_type: type, objects: Iterable[NamedTuple] = ()):
+        self.object_type = object_type
+        self.columns: dict[str, Any] = {}
+
+        objects = sorted(objects, key=attrgetter("beat"))
+        rows = list(zip(*objects)) if objects else [()] * len(object_type._fields)
+        for name, values in zip(object_type._fields, rows):
+            annotation = object_type.__annotations__[name]
+            if isinstance(annotation, type) and issubclass(annotation, Enum):
+                values = [v.value for v in values]
+            elif annotation is int and any(type(v) is float for v in values):
+                # some maps in the wild use fractional values where we expect integers
+                annotation = float
+            typecode, dtype = _column_type(annotation)
+            self.columns[name] = np.array(values, dtype=dtype) if np is not None else array(typecode, values)
+
+    @classmethod
+    def _from_columns(cls, object_type: type, columns: dict[str, Any]) -> "ObjectColumns":
+        obj = cls.__new__(cls)
+        obj.object_type = object_type
+        obj.columns = columns
+        return obj
+
+    def __len__(self) -> int:
+        return len(self.columns["beat"])
+
+    def __getitem__(self, name: str):
+        return self.columns[name]
+
+    def index_range(self, start_beat: float, end_beat: float) -> slice:
+        """The slice of objects with `start_beat <= beat < end_beat`."""
+        beats = self.columns["beat"]
+        if np is not None:
+            start, end = np.searchsorted(beats, (start_beat, end_beat), side="left").tolist()
+        else:
+            start, end = bisect_left(beats, start_beat), bisect_left(beats, end_beat)
+        return slice(start, max(start, end))
+
+    def between(self, start_beat: float, end_beat: float) -> "ObjectColumns":
+        """All objects with `start_beat <= beat < end_beat`, sharing memory with these columns where possible."""
+        span = self.index_range(start_beat, end_beat)
+        return self._from_columns(self.object_type, {name: col[span] for name, col in self.columns.items()})
+
+    def count_by(self, name: str = "x") -> dict[int, int]:
+        """Number of objects per distinct value of a field, e.g. per column."""
+        col = self.columns[name]
+        if np is not None:
+            values, counts = np.unique(col, return_counts=True)
+            return dict(zip(values.tolist(), counts.tolist()))
+        return dict(sorted(Counter(col).items()))
+
+    def _lists(self) -> list[list]:
+        lists = []
+        for name in self.object_type._fields:
+            values = self.columns[name].tolist()
+            if self.object_type.__annotations__[name] is bool and np is None:
+                values = [bool(v) for v in values]
+            lists.append(values)
+        return lists
+
+    def objects(self) -> list[NamedTuple]:
+        fields = []
+        for name, values in zip(self.object_type._fields, self._lists()):
+            annotation = self.object_type.__annotations__[name]
+            if isinstance(annotation, type) and issubclass(annotation, Enum):
+                values = map(annotation, values)
+            fields.append(values)
+        return list(map(self.object_type, *fields))
+
+    def dicts(self, keys: tuple[tuple[str, str], ...]) -> list[dict[str, Any]]:
+        """The objects as v3 JSON dicts, with `(json key, field name)` pairs in emitted order."""
+        by_name = dict(zip(self.object_type._fields, self._lists()))
+        json_keys = [key for key, _ in keys]
+        return [dict(zip(json_keys, row)) for row in zip(*(by_name[name] for _, name in keys))]
+
+
+class ColumnarDifficultyBeatmap:
+    """Columnar counterpart of a `DifficultyBeatmap` for fast queries over large maps.
+
+    Each object list of the difficulty becomes an `ObjectColumns` under the same attribute name.
+    """
+
+    def __init__(self, diff_map: DifficultyBeatmap):
+        self.filename = diff_map.filename
+        self.difficulty = diff_map.difficulty
+        self.note_jump_speed = diff_map.note_jump_speed
+        self.note_jump_offset = diff_map.note_jump_offset
+        self.version = diff_map.version
+        self.compatible_events = diff_map.compatible_events
+
+        for attr, schema in V3_OBJECT_SCHEMAS.items():
+            setattr(self, attr, ObjectColumns(schema.object_type, getattr(diff_map, attr)))
+
+    def notes_between(self, start_beat: float, end_beat: float) -> ObjectColumns:
+        return self.color_notes.between(start_beat, end_beat)
+
+    def count_per_column(self) -> dict[int, int]:
+        return self.color_notes.count_by("x")
+
+    def to_difficulty_beatmap(self) -> DifficultyBeatmap:
+        diff_map = DifficultyBeatmap(self.filename, self.difficulty, self.note_jump_speed, self.note_jump_offset)
+        diff_map.version = self.version
+        diff_map.compatible_events = self.compatible_events
+        for attr in V3_OBJECT_SCHEMAS:
+            setattr(diff_map, attr, getattr(self, attr).objects())
+        return diff_map
+
+    def data_dict(self) -> dict[str, Any]:
+        """Same layout as `DifficultyBeatmap.data_dict`, with every object list in beat order."""
+        lists = {schema.key: getattr(self, attr).dicts(schema.fields) for attr, schema in V3_OBJECT_SCHEMAS.items()}
+        return {
+            "version": self.version,
+            "bpmEvents": lists["bpmEvents"],
+            "rotationEvents": lists["rotationEvents"],
+            "colorNotes": lists["colorNotes"],
+            "bombNotes": lists["bombNotes"],
+            "obstacles": lists["obstacles"],
+            "sliders": lists["sliders"],
+            "burstSliders": lists["burstSliders"],
+            "waypoints": [],
+            "basicBeatmapEvents": lists["basicBeatmapEvents"],
+            "colorBoostBeatmapEvents": lists["colorBoostBeatmapEvents"],
+            "lightColorEventBoxGroups": [],
+            "lightRotationEventBoxGroups": [],
+            "basicEventTypesWithKeywords": {
+                "d": []
+            },
+            "useNormalEventsAsCompatibleEvents": self.compatible_events
+        }
@@ -1,8 +1,17 @@
+import io
 import json
+import shutil
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from dataclasses import dataclass, field
 from enum import Enum
+from operator import attrgetter
 from pathlib import Path
-from typing import Optional, Union, NamedTuple, Any
+from typing import Optional, Union, NamedTuple, Any, Iterator, TextIO, Callable, BinaryIO, Collection
+
+import instrument
+from timing import TempoMap
 
 
 class Environment(Enum):
@@ -162,6 +171,80 @@ class BasicEvent(NamedTuple):
     float_value: float
 
 
+class ObjectSchema(NamedTuple):
+    object_type: type
+    key: str
+    fields: tuple[tuple[str, str], ...]  # (json key, field name)
+
+
+# Every list of beatmap objects in a DifficultyBeatmap, by attribute name,
+# in the order DifficultyBeatmap.data_dict() emits them.
+V3_OBJECT_SCHEMAS: dict[str, ObjectSchema] = {
+    "bpm_events": ObjectSchema(BPMEvent, "bpmEvents", (("b", "beat"), ("m", "new_bpm"))),
+    "rotation_events": ObjectSchema(RotationEvent, "rotationEvents", (("b", "beat"), ("e", "type_"), ("r", "angle"))),
+    "color_notes": ObjectSchema(ColorNote, "colorNotes", (
+        ("b", "beat"), ("x", "x"), ("y", "y"), ("c", "color"), ("d", "direction"), ("a", "angle_offset")
+    )),
+    "bomb_notes": ObjectSchema(BombNote, "bombNotes", (("b", "beat"), ("x", "x"), ("y", "y"))),
+    "obstacles": ObjectSchema(Obstacle, "obstacles", (
+        ("b", "beat"), ("x", "x"), ("y", "y"), ("d", "duration"), ("w", "width"), ("h", "height")
+    )),
+    "sliders": ObjectSchema(Slider, "sliders", (
+        ("b", "beat"), ("c", "color"), ("x", "x"), ("y", "y"), ("d", "direction"), ("mu", "multiplier"),
+        ("tb", "tail_beat"), ("tx", "tail_x"), ("ty", "tail_y"), ("tc", "tail_direction"),
+        ("tmu", "tail_multiplier"), ("m", "mid_anchor_mode")
+    )),
+    "burst_sliders": ObjectSchema(BurstSlider, "burstSliders", (
+        ("b", "beat"), ("x", "x"), ("y", "y"), ("c", "color"), ("d", "direction"), ("tb", "tail_beat"),
+        ("tx", "tail_x"), ("ty", "tail_y"), ("sc", "segment_count"), ("s", "squish_factor")
+    )),
+    "basic_events": ObjectSchema(BasicEvent, "basicBeatmapEvents", (
+        ("b", "beat"), ("et", "type_"), ("i", "int_value"), ("f", "float_value")
+    )),
+    "colorboost_events": ObjectSchema(ColorBoost, "colorBoostBeatmapEvents", (("b", "beat"), ("o", "enable"))),
+}
+
+
+_JSON_BOOLS = {True: "true", False: "false"}
+_JSON_WRITE_CHUNK = 4096
+
+
+def _json_column(values: tuple, annotation: Any) -> Iterator[str]:
+    if annotation is bool:
+        return map(_JSON_BOOLS.__getitem__, values)
+    if isinstance(annotation, type) and issubclass(annotation, Enum):
+        return map(repr, map(attrgetter("value"), values))
+    return map(repr, values)
+
+
+def _write_json_objects(f: TextIO, schema: ObjectSchema, objects: list) -> None:
+    """Write a list of beatmap objects exactly as json.dump() writes their data_dict() entries."""
+    if not objects:
+        f.write("[]")
+        return
+
+    object_type = schema.object_type
+    field_idx = [object_type._fields.index(name) for _, name in schema.fields]
+    annotations = [object_type.__annotations__[name] for _, name in schema.fields]
+    template = "{" + ", ".join(f'"{key}": %s' for key, _ in schema.fields) + "}"
+
+    f.write("[")
+    for start in range(0, len(objects), _JSON_WRITE_CHUNK):
+        columns = list(zip(*objects[start:start + _JSON_WRITE_CHUNK]))
+        rows = zip(*(_json_column(columns[idx], annotation) for idx, annotation in zip(field_idx, annotations)))
+        text = ", ".join(map(template.__mod__, rows))
+        if "nan" in text or "inf" in text:
+            # json spells these differently than repr does, let it handle the rare chunk that has them
+            text = json.dumps([
+                {key: getattr(value, "value", value) for (key, _), value in zip(schema.fields, row)}
+                for row in zip(*(columns[idx] for idx in field_idx))
+            ])[1:-1]
+        if start:
+            f.write(", ")
+        f.write(text)
+    f.write("]")
+
+
 @dataclass()
 class BPMRegion:
     start_sample_idx: int
@@ -216,34 +299,33 @@ class BPMInfo:
         return data
 
     def load_regions_from_events(self, events: list[BPMEvent], initial_bpm: Optional[float] = None):
-        if initial_bpm is None:
-            if events[0].beat != 0.0:
-                raise ValueError("Missing bpm at beat 0")
-            initial_bpm = events[0].new_bpm
-
-        self.regions.clear()
-        self.regions.append(BPMRegion(0, 0, 0.0, 0.0))
-
-        sample_idx = 0.0
-        current_bpm = initial_bpm
-        for event in events:
-            if event.beat == 0.0:
-                continue
+        self.load_regions_from_tempo_map(TempoMap(events, initial_bpm, self.sample_rate))
 
-            sample_idx += self.sample_rate * (event.beat - self.regions[-1].start_beat) / (current_bpm / 60)
-            self.regions[-1].end_beat = event.beat
-            self.regions[-1].end_sample_idx = int(sample_idx) - 1
-            self.regions.append(BPMRegion(int(sample_idx), 0, event.beat, 0.0))
+    def load_regions_from_tempo_map(self, tempo_map: TempoMap):
+        if tempo_map.sample_rate != self.sample_rate:
+            raise ValueError("The tempo map's sample rate doesn't match")
+        if tempo_map.has_pauses:
+            raise ValueError("BPM regions can't represent stops, delays or warps")
 
-            current_bpm = event.new_bpm
+        self.regions.clear()
+        for start_beat, start_sample_idx in zip(tempo_map.beats, tempo_map.samples):
+            if self.regions:
+                self.regions[-1].end_beat = start_beat
+                self.regions[-1].end_sample_idx = int(start_sample_idx) - 1
+            self.regions.append(BPMRegion(int(start_sample_idx), 0, start_beat, 0.0))
 
+        sample_idx = tempo_map.samples[-1]
         sample_count = self.sample_count
         if self.sample_count == -1:
             sample_count = sample_idx + self.sample_rate * 5
 
         self.regions[-1].end_sample_idx = sample_count - 1
         self.regions[-1].end_beat = self.regions[-1].start_beat + (
-                sample_count - sample_idx) / self.sample_rate * current_bpm / 60
+                sample_count - sample_idx) / self.sample_rate * tempo_map.bpms[-1] / 60
+
+
+# attributes of a DifficultyBeatmap that are read from its difficulty file
+_LAZY_ATTRS = ("version", *V3_OBJECT_SCHEMAS, "compatible_events")
 
 
 @dataclass()
@@ -253,7 +335,8 @@ class DifficultyBeatmap:
     note_jump_speed: float = 18.0
     note_jump_offset: float = 0.0
 
-    version: str = ""
+    # fields read from the difficulty file have no class-level default, so they can be loaded lazily
+    version: str = field(default_factory=str)
 
     bpm_events: list[BPMEvent] = field(default_factory=list)
     rotation_events: list[RotationEvent] = field(default_factory=list)
@@ -271,12 +354,49 @@ class DifficultyBeatmap:
     light_rotation_event_box_groups: list[...] = field(default_factory=list)  # TODO ^
     basic_event_types_with_keywords: ... = None  # TODO ^
 
-    compatible_events: bool = False  # TODO ^
+    compatible_events: bool = field(default_factory=bool)  # TODO ^
+
+    # file the objects were loaded from, so they can be released and loaded again
+    _source_path = None
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for attributes that aren't set, i.e. the fields of a difficulty that hasn't been loaded yet
+        if name in _LAZY_ATTRS and self._source_path is not None:
+            self.ensure_loaded()
+            return self.__dict__[name]
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+    @property
+    def loaded(self) -> bool:
+        return all(attr in self.__dict__ for attr in _LAZY_ATTRS)
+
+    def defer_load(self, diff_path: Path) -> None:
+        """Load the objects from `diff_path` the first time any of them is accessed."""
+        self._source_path = diff_path
+        self.unload()
+
+    def ensure_loaded(self) -> None:
+        if not self.loaded:
+            for attr in V3_OBJECT_SCHEMAS:
+                self.__dict__[attr] = []
+            self.load_from_file(self._source_path)
+
+    def unload(self) -> None:
+        """Release the objects of a difficulty read from disk, they are read again on the next access.
+
+        Any changes made to them since they were loaded are lost.
+        """
+        if self._source_path is None:
+            raise ValueError("Only difficulties loaded from a file can be unloaded")
+        for attr in _LAZY_ATTRS:
+            self.__dict__.pop(attr, None)
 
     def load_from_file(self, diff_path: Path) -> None:
         with diff_path.open("rt", encoding="utf-8") as f:
             data: dict[str, Any] = json.load(f)
 
+        self._source_path = diff_path
+
         if data["version"] != "3.0.0":
             raise ValueError("Only the 3.0.0 difficulty format is currently supported")
 
@@ -377,7 +497,10 @@ class DifficultyBeatmap:
 
         self.compatible_events = data["useNormalEventsAsCompatibleEvents"]
 
+    @instrument.stage("bsmap.DifficultyBeatmap.data_dict")
     def data_dict(self) -> dict[str, Any]:
+        self.ensure_loaded()
+
         data = {
             "version": self.version,
             "bpmEvents": [],
@@ -449,13 +572,13 @@ class DifficultyBeatmap:
                 "tb": slider.tail_beat,
                 "tx": slider.tail_x,
                 "ty": slider.tail_y,
-                "tc": slider.tail_direction,
+                "tc": slider.tail_direction.value,
                 "tmu": slider.tail_multiplier,
                 "m": slider.mid_anchor_mode.value
             })
 
         for burst_slider in self.burst_sliders:
-            data["sliders"].append({
+            data["burstSliders"].append({
                 "b": burst_slider.beat,
                 "x": burst_slider.x,
                 "y": burst_slider.y,
@@ -484,6 +607,24 @@ class DifficultyBeatmap:
 
         return data
 
+    @instrument.stage("bsmap.DifficultyBeatmap.write_json")
+    def write_json(self, f: TextIO) -> None:
+        """Write the same JSON as `json.dump(self.data_dict(), f)`, without building the intermediate dicts."""
+        self.ensure_loaded()
+
+        f.write(f'{{"version": {json.dumps(self.version)}')
+        for attr, schema in V3_OBJECT_SCHEMAS.items():
+            if attr == "basic_events":
+                # waypoints aren't supported, but data_dict() puts them right before the basic events
+                f.write(', "waypoints": []')
+            f.write(f', "{schema.key}": ')
+            _write_json_objects(f, schema, getattr(self, attr))
+        f.write(
+            ', "lightColorEventBoxGroups": [], "lightRotationEventBoxGroups": []'
+            ', "basicEventTypesWithKeywords": {"d": []}'
+            f', "useNormalEventsAsCompatibleEvents": {json.dumps(self.compatible_events)}}}'
+        )
+
     def info_data_dict(self) -> dict[str, Any]:
         return {
             "_difficulty": self.difficulty.difficulty,
@@ -494,6 +635,66 @@ class DifficultyBeatmap:
         }
 
 
+# called with a stage name, the number of steps done and the total, may raise to abort
+ProgressCallback = Callable[[str, int, int], None]
+
+_ZIP_CHUNK_SIZE = 1 << 20
+
+
+def _open_zip_text(zf: zipfile.ZipFile, filename: str) -> TextIO:
+    info = zipfile.ZipInfo(filename, time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return io.TextIOWrapper(zf.open(info, "w"), encoding="utf-8")
+
+
+class DifficultyFileError(Exception):
+    """Reading or writing some of the difficulty files of a map failed."""
+
+    def __init__(self, errors: list[tuple[str, Exception]]):
+        super().__init__("; ".join(f"{filename}: {error}" for filename, error in errors))
+        self.errors = errors
+
+
+def _load_difficulty(diff_map: DifficultyBeatmap, diff_path: Path) -> DifficultyBeatmap:
+    diff_map.load_from_file(diff_path)
+    return diff_map
+
+
+def _save_difficulty(diff_map: DifficultyBeatmap, diff_path: Path) -> None:
+    # a lazily loaded difficulty might be saved over the file it's still to be read from
+    diff_map.ensure_loaded()
+    with instrument.measure("bsmap.save_to_disk.write") as measurement, \
+            diff_path.open("wt", encoding="utf-8") as diff_file:
+        diff_map.write_json(diff_file)
+        measurement.add(1)
+
+
+def _run_per_difficulty(
+        fn: Callable[[DifficultyBeatmap, Path], Any],
+        jobs: list[tuple[DifficultyBeatmap, Path]],
+        workers: int,
+        use_processes: bool,
+        on_done: Optional[Callable[[int], None]] = None
+) -> list[Any]:
+    executor_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_type(workers) as executor:
+        futures = [executor.submit(fn, diff_map, diff_path) for diff_map, diff_path in jobs]
+        if on_done is not None:
+            for done, _ in enumerate(as_completed(futures), 1):
+                on_done(done)
+
+    results = []
+    errors = []
+    for (diff_map, _), future in zip(jobs, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            errors.append((diff_map.filename, e))
+    if errors:
+        raise DifficultyFileError(errors)
+    return results
+
+
 @dataclass()
 class DifficultyBeatmapSet:
     characteristic: Characteristic = Characteristic.STANDARD
@@ -532,7 +733,20 @@ class BeatMap:
     bpm_info: Optional[BPMInfo] = None
 
     @classmethod
-    def load_from_file(cls, fp: Union[str, Path]) -> "BeatMap":
+    def load_from_file(
+            cls,
+            fp: Union[str, Path],
+            lazy: bool = False,
+            workers: Optional[int] = None,
+            use_processes: bool = False
+    ) -> "BeatMap":
+        """Load a map from its Info.dat or the directory holding it.
+
+        With `lazy` set, difficulty files are only read once their objects are accessed.
+        Otherwise, if `workers` is set, difficulty files are read concurrently by a thread pool
+        of that size, or a process pool if `use_processes` is set. Difficulties that failed to
+        load are then reported together in a DifficultyFileError.
+        """
         if not isinstance(fp, Path):
             fp = Path(fp)
 
@@ -572,10 +786,20 @@ class BeatMap:
                     diff_data["_noteJumpStartBeatOffset"]
                 )
                 diff_path = fp.parent / diff_map.filename
-                diff_map.load_from_file(diff_path)
+                if lazy:
+                    diff_map.defer_load(diff_path)
+                elif workers is None:
+                    diff_map.load_from_file(diff_path)
                 diff_set.diff_maps.append(diff_map)
             beatmap.difficulty_beatmap_sets.append(diff_set)
 
+        if workers is not None and not lazy:
+            jobs = [(dm, fp.parent / dm.filename) for dbs in beatmap.difficulty_beatmap_sets for dm in dbs.diff_maps]
+            loaded = iter(_run_per_difficulty(_load_difficulty, jobs, workers, use_processes))
+            # a process pool hands back copies, so put those in place of the originals
+            for dbs in beatmap.difficulty_beatmap_sets:
+                dbs.diff_maps = [next(loaded) for _ in dbs.diff_maps]
+
         return beatmap
 
     def data_dict(self) -> dict[str, Any]:
@@ -598,23 +822,99 @@ class BeatMap:
             "_difficultyBeatmapSets": [dbs.data_dict() for dbs in self.difficulty_beatmap_sets]
         }
 
-    def save_to_disk(self, path: Union[str, Path]):
+    def save_to_zip(self, target: Union[str, Path, BinaryIO], audio_path: Union[str, Path, None] = None):
+        """Write the map, and optionally its audio, straight into a zip archive.
+
+        `target` is a path or a writable binary file, like an io.BytesIO. The JSON files are
+        deflated as they're written; the audio is stored as is, since it's compressed already,
+        and copied in chunks under the map's song filename.
+        """
+        with zipfile.ZipFile(target, "w") as zf:
+            with _open_zip_text(zf, "Info.dat") as info_file:
+                json.dump(self.data_dict(), info_file)
+
+            if self.bpm_info is not None:
+                with _open_zip_text(zf, "BPMInfo.dat") as bpm_file:
+                    json.dump(self.bpm_info.data_dict(), bpm_file)
+
+            for dbs in self.difficulty_beatmap_sets:
+                for dm in dbs.diff_maps:
+                    with _open_zip_text(zf, dm.filename) as diff_file:
+                        dm.write_json(diff_file)
+
+            if audio_path is not None:
+                audio_info = zipfile.ZipInfo.from_file(audio_path, self.song_filename)
+                audio_info.compress_type = zipfile.ZIP_STORED
+                with open(audio_path, "rb") as audio_file, zf.open(audio_info, "w") as zip_audio_file:
+                    shutil.copyfileobj(audio_file, zip_audio_file, _ZIP_CHUNK_SIZE)
+
+    def filenames(self) -> list[str]:
+        """Names of the files save_to_disk() writes, not including the audio."""
+        filenames = ["Info.dat"]
+        if self.bpm_info is not None:
+            filenames.append("BPMInfo.dat")
+        for dbs in self.difficulty_beatmap_sets:
+            filenames.extend(dm.filename for dm in dbs.diff_maps)
+        return filenames
+
+    def save_to_disk(
+            self,
+            path: Union[str, Path],
+            workers: Optional[int] = None,
+            use_processes: bool = False,
+            progress: Optional[ProgressCallback] = None,
+            only: Optional[Collection[str]] = None
+    ):
+        """Write the map to a directory.
+
+        If `workers` is set, difficulty files are written concurrently by a thread pool of that
+        size, or a process pool if `use_processes` is set. Difficulties that failed to save are
+        then reported together in a DifficultyFileError.
+
+        With `only` set, only the difficulty files with those filenames are written, along
+        with Info.dat and BPMInfo.dat; the others are left as they are on disk.
+
+        `progress` is called with ("save", files written, total files) after every file.
+        """
         if not isinstance(path, Path):
             path = Path(path)
+        diff_maps = [dm for dbs in self.difficulty_beatmap_sets for dm in dbs.diff_maps
+                     if only is None or dm.filename in only]
+        total = len(diff_maps) + (2 if self.bpm_info is not None else 1)
+        done = 0
+
+        def report(count: int):
+            if progress is not None:
+                progress("save", count, total)
 
         path.mkdir(exist_ok=True)
+        report(done)
 
         info_path = path / "Info.dat"
-        with info_path.open("wt", encoding="utf-8") as info_file:
+        with instrument.measure("bsmap.save_to_disk.write") as measurement, \
+                info_path.open("wt", encoding="utf-8") as info_file:
             json.dump(self.data_dict(), info_file)
+            measurement.add(1)
+        done += 1
+        report(done)
 
         if self.bpm_info is not None:
             bpm_path = path / "BPMInfo.dat"
-            with bpm_path.open("wt", encoding="utf-8") as bpm_file:
+            with instrument.measure("bsmap.save_to_disk.write") as measurement, \
+                    bpm_path.open("wt", encoding="utf-8") as bpm_file:
                 json.dump(self.bpm_info.data_dict(), bpm_file)
-
-        for dbs in self.difficulty_beatmap_sets:
-            for dm in dbs.diff_maps:
-                diff_path = path / dm.filename
-                with diff_path.open("wt", encoding="utf-8") as diff_file:
-                    json.dump(dm.data_dict(), diff_file)
+                measurement.add(1)
+            done += 1
+            report(done)
+
+        if workers is not None:
+            jobs = [(dm, path / dm.filename) for dm in diff_maps]
+            written_before = done
+            _run_per_difficulty(_save_difficulty, jobs, workers, use_processes,
+                                lambda count: report(written_before + count))
+            return
+
+        for dm in diff_maps:
+            _save_difficulty(dm, path / dm.filename)
+            done += 1
+            report(done)
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Optional
+
+from convert import CONVERTER_VERSION
+from filehash import CHUNK_SIZE, file_digest
+
+MANIFEST_NAME = "manifest.json"
+
+
+class ConversionCache:
+    """Persistent cache of converted maps, keyed by the input file and the conversion settings.
+
+    Every entry is a directory holding the converted files and a manifest. Entries
+    are written to a temporary directory first and moved into place, so several
+    processes can share one cache. `evict()` drops the least recently used entries
+    until the cache fits in `max_bytes`; it walks the whole cache, so call it once
+    after a run rather than after every store.
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 1 << 30):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def key(self, sm_path: Path, **params: Any) -> str:
+        digest = hashlib.sha256()
+        digest.update(json.dumps([CONVERTER_VERSION, sorted(params.items())]).encode("utf-8"))
+        with sm_path.open("rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def restore(
+            self,
+            key: str,
+            output_path: Path,
+            renames: Optional[dict[str, str]] = None
+    ) -> Optional[dict[str, Any]]:
+        """Make `output_path` match a cached conversion.
+
+        Files that are already identical are left alone. `renames` maps names of files in
+        the entry to the names to restore them as. Returns the extra data stored with the
+        entry, or None if the key is not in the cache.
+        """
+        renames = renames or {}
+        entry_path = self._entry_path(key)
+        manifest_path = entry_path / MANIFEST_NAME
+        try:
+            with manifest_path.open("rt", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        output_path.mkdir(parents=True, exist_ok=True)
+        for filename, (size, digest) in manifest["files"].items():
+            out_file = output_path / renames.get(filename, filename)
+            if out_file.is_file() and out_file.stat().st_size == size and file_digest(out_file) == digest:
+                continue
+            shutil.copyfile(entry_path / filename, out_file)
+
+        # the manifest's mtime marks when an entry was last used
+        os.utime(manifest_path)
+        return manifest["extra"]
+
+    def store(
+            self,
+            key: str,
+            output_path: Path,
+            filenames: list[str],
+            extra: Optional[dict[str, Any]] = None,
+            renames: Optional[dict[str, str]] = None
+    ):
+        """Add the given files of a finished conversion to the cache.
+
+        `renames` maps names in `filenames` to the names of the files in `output_path`, like for `restore()`.
+        """
+        renames = renames or {}
+        entry_path = self._entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_path = Path(tempfile.mkdtemp(prefix=f".{key}.", dir=entry_path.parent))
+        try:
+            files = {}
+            for filename in filenames:
+                shutil.copyfile(output_path / renames.get(filename, filename), tmp_path / filename)
+                files[filename] = [(tmp_path / filename).stat().st_size, file_digest(tmp_path / filename)]
+            with (tmp_path / MANIFEST_NAME).open("wt", encoding="utf-8") as f:
+                json.dump({"files": files, "extra": extra or {}}, f)
+            try:
+                os.replace(tmp_path, entry_path)
+            except OSError:
+                # another process stored the same entry first
+                pass
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def evict(self) -> int:
+        """Remove least recently used entries until the cache fits its size bound. Returns the number removed."""
+        entries = []
+        total_size = 0
+        for manifest_path in self.root.glob(f"*/*/{MANIFEST_NAME}"):
+            entry_path = manifest_path.parent
+            try:
+                size = sum(f.stat().st_size for f in entry_path.iterdir())
+                entries.append((manifest_path.stat().st_mtime, size, entry_path))
+            except FileNotFoundError:
+                continue
+            total_size += size
+
+        removed = 0
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            shutil.rmtree(entry_path, ignore_errors=True)
+            total_size -= size
+            removed += 1
+        return removed
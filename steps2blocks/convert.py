@@ -1,8 +1,34 @@
 import logging
+from enum import Enum
+from heapq import merge
+from itertools import compress, repeat
+from operator import eq, gt, not_, or_, truediv, attrgetter
+from typing import NamedTuple, Optional, Iterable
 
 from bsmap import Difficulty as BSDiff, BeatMap, BPMEvent, BPMInfo, DifficultyBeatmapSet, DifficultyBeatmap, \
-    ColorNote, BombNote
-from smmap import Difficulty as SMDiff, SMSong, ChartType, TICKS_PER_BEAT, NoteType
+    ColorNote, BombNote, Slider, BurstSlider, NoteColor, CutDirection, MidAnchorMode, ProgressCallback
+from smmap import Difficulty as SMDiff, SMSong, ChartType, TICKS_PER_BEAT, NoteType, NoteArray
+import instrument
+from diagnostics import Diagnostics, IssueKind
+from timing import TempoMap
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Bump whenever a change to the conversion changes its output, this invalidates cached conversions.
+CONVERTER_VERSION = "3"
+
+_NORMAL_CODE = ord(NoteType.NORMAL.value)
+_MINE_CODE = ord(NoteType.MINE.value)
+_STOP_HOLD_ROLL_CODE = ord(NoteType.STOP_HOLD_ROLL.value)
+_HOLD_HEAD_CODES = {ord(NoteType.START_HOLD.value), ord(NoteType.START_ROLL.value)}
+_HOLD_CODES = {*_HOLD_HEAD_CODES, _STOP_HOLD_ROLL_CODE}
+
+BURST_SLIDER_SEGMENTS = 3
+# the fields of a ColorNote after its beat and column
+_COLOR_NOTE_REST = (repeat(0), *map(repeat, ColorNote._field_defaults.values()))
 
 DIFF_MAPPING = {
     SMDiff.BEGINNER: BSDiff.EASY,
@@ -13,7 +39,201 @@ DIFF_MAPPING = {
 }
 
 
-def beatmap_from_sm(sm: SMSong, sample_count: int = -1, sample_rate: int = 44100) -> BeatMap:
+class ConversionCancelled(Exception):
+    """Raised by a progress callback to stop a conversion."""
+
+
+class ClassifiedNotes(NamedTuple):
+    color_beats: list[float]
+    color_columns: list[int]
+    bomb_beats: list[float]
+    bomb_columns: list[int]
+    ignored: list[tuple[int, float, bool]]  # (note index, beat, skipped by a warp)
+
+
+def classify_notes(
+        notes: NoteArray,
+        song_timing: Optional[TempoMap] = None,
+        bpm_timing: Optional[TempoMap] = None
+) -> ClassifiedNotes:
+    """Convert the ticks of a whole chart to beats and split its notes into notes, bombs and the rest at once.
+
+    If the song's timing has stops, delays or warps, `song_timing` and `bpm_timing`
+    are its full timing and its BPM changes alone. Since Beat Saber only knows about
+    BPM changes, every note then moves to the beat that is played at the same time
+    with the BPM changes alone, and notes skipped by a warp are ignored.
+    """
+    if np is not None:
+        return _classify_notes_numpy(notes, song_timing, bpm_timing)
+
+    beats = list(map(truediv, notes.ticks, repeat(TICKS_PER_BEAT)))
+    is_color = list(map(eq, notes.types, repeat(_NORMAL_CODE)))
+    is_bomb = list(map(eq, notes.types, repeat(_MINE_CODE)))
+    warped = None
+    if song_timing is not None:
+        warped = song_timing.warped_beats(beats)
+        beats = bpm_timing.seconds_to_beats(song_timing.beats_to_seconds(beats))
+        # a and not b
+        is_color = list(map(gt, is_color, warped))
+        is_bomb = list(map(gt, is_bomb, warped))
+
+    is_ignored = list(map(not_, map(or_, is_color, is_bomb)))
+    ignored_idx = list(compress(range(len(beats)), is_ignored))
+    return ClassifiedNotes(
+        list(compress(beats, is_color)),
+        list(compress(notes.columns, is_color)),
+        list(compress(beats, is_bomb)),
+        list(compress(notes.columns, is_bomb)),
+        list(zip(
+            ignored_idx,
+            compress(beats, is_ignored),
+            compress(warped, is_ignored) if warped is not None else repeat(False)
+        ))
+    )
+
+
+def _classify_notes_numpy(
+        notes: NoteArray,
+        song_timing: Optional[TempoMap],
+        bpm_timing: Optional[TempoMap]
+) -> ClassifiedNotes:
+    ticks = np.frombuffer(notes.ticks, dtype=np.intc)
+    columns = np.frombuffer(notes.columns, dtype=np.int8)
+    types = np.frombuffer(notes.types, dtype=np.uint8)
+
+    beats = ticks / TICKS_PER_BEAT
+    is_color = types == _NORMAL_CODE
+    is_bomb = types == _MINE_CODE
+    warped = np.zeros(len(beats), dtype=bool)
+    if song_timing is not None:
+        beat_list = beats.tolist()
+        warped = np.array(song_timing.warped_beats(beat_list), dtype=bool)
+        beats = np.array(bpm_timing.seconds_to_beats(song_timing.beats_to_seconds(beat_list)), dtype=np.float64)
+        is_color &= ~warped
+        is_bomb &= ~warped
+
+    is_ignored = ~(is_color | is_bomb)
+    return ClassifiedNotes(
+        beats[is_color].tolist(),
+        columns[is_color].tolist(),
+        beats[is_bomb].tolist(),
+        columns[is_bomb].tolist(),
+        list(zip(np.flatnonzero(is_ignored).tolist(), beats[is_ignored].tolist(), warped[is_ignored].tolist()))
+    )
+
+
+class HoldPolicy(Enum):
+    """What holds and rolls turn into."""
+    IGNORE = "ignore"  # nothing, they're skipped like other unsupported notes
+    HEAD_NOTE = "head"  # a color note where they start
+    SLIDER = "slider"  # a color note where they start with an arc to where they end
+    BURST_SLIDER = "burst"  # a burst slider from where they start to where they end
+
+
+class HoldPairingError(NamedTuple):
+    """A hold or roll head without a tail, or a tail without a head."""
+    message: str
+    tick: int
+    column: int
+    note_type: NoteType
+
+
+def pair_holds(notes: NoteArray, indices: Iterable[int]) -> tuple[list[int], list[HoldPairingError]]:
+    """Pair the hold and roll heads among the given notes with their tails.
+
+    `indices` are positions in `notes`, in tick order. This is a single pass keeping a
+    stack of open heads per column. Returns, for every note, the position of its tail
+    if it's a matched head and -1 otherwise, along with every unmatched head or tail.
+    """
+    tails = [-1] * len(notes)
+    open_heads: dict[int, list[int]] = {}
+    errors = []
+
+    for idx in indices:
+        code = notes.types[idx]
+        column = notes.columns[idx]
+        if code == _STOP_HOLD_ROLL_CODE:
+            column_heads = open_heads.get(column)
+            if column_heads:
+                tails[column_heads.pop()] = idx
+            else:
+                errors.append(HoldPairingError("tail without a head", notes.ticks[idx], column,
+                                               NoteType.STOP_HOLD_ROLL))
+        elif code in _HOLD_HEAD_CODES:
+            open_heads.setdefault(column, []).append(idx)
+
+    unmatched = sorted(idx for column_heads in open_heads.values() for idx in column_heads)
+    for idx in unmatched:
+        errors.append(HoldPairingError("head without a tail", notes.ticks[idx], notes.columns[idx],
+                                       notes[idx].note_type))
+
+    return tails, errors
+
+
+def _convert_holds(
+        diff_map: DifficultyBeatmap,
+        notes: NoteArray,
+        ignored: list[tuple[int, float, bool]],
+        hold_policy: HoldPolicy,
+        diagnostics: Diagnostics,
+        scope: str
+) -> list[tuple[int, float, bool]]:
+    """Add the holds and rolls among the ignored notes to the map, returns the notes that are still ignored."""
+    hold_idx = [idx for idx, _, is_warped in ignored if not is_warped and notes.types[idx] in _HOLD_CODES]
+    beat_at = {idx: beat for idx, beat, _ in ignored}
+    tails, errors = pair_holds(notes, hold_idx)
+
+    for error in errors:
+        diagnostics.add(scope, IssueKind.UNPAIRED_HOLD, error.tick / TICKS_PER_BEAT, error.message)
+
+    head_notes = []
+    for idx in hold_idx:
+        tail_idx = tails[idx]
+        if tail_idx == -1:
+            continue
+        beat, column = beat_at[idx], notes.columns[idx]
+        if hold_policy is HoldPolicy.BURST_SLIDER:
+            diff_map.burst_sliders.append(BurstSlider(
+                beat, column, 0, NoteColor.RIGHT, CutDirection.ANY,
+                beat_at[tail_idx], column, 0, BURST_SLIDER_SEGMENTS, 1.0
+            ))
+            continue
+        head_notes.append(ColorNote(beat, column, 0))
+        if hold_policy is HoldPolicy.SLIDER:
+            diff_map.sliders.append(Slider(
+                beat, column, 0, NoteColor.RIGHT, CutDirection.ANY, 1.0,
+                beat_at[tail_idx], column, 0, CutDirection.ANY, 1.0, MidAnchorMode.STRAIGHT
+            ))
+
+    if head_notes:
+        diff_map.color_notes = list(merge(diff_map.color_notes, head_notes, key=attrgetter("beat")))
+
+    return [note for note in ignored if note[2] or notes.types[note[0]] not in _HOLD_CODES]
+
+
+@instrument.stage("convert.beatmap_from_sm")
+def beatmap_from_sm(
+        sm: SMSong,
+        sample_count: int = -1,
+        sample_rate: int = 44100,
+        hold_policy: HoldPolicy = HoldPolicy.HEAD_NOTE,
+        progress: Optional[ProgressCallback] = None,
+        diagnostics: Optional[Diagnostics] = None,
+        reuse: Optional[dict[int, DifficultyBeatmap]] = None
+) -> BeatMap:
+    """Convert a song to a Beat Saber map.
+
+    `reuse` maps the indices of charts that are unchanged since an earlier conversion
+    of the song, with the same timing and settings, to their converted difficulties.
+    Those are put in the map as they are instead of being converted again.
+
+    `progress` is called with ("convert", charts done, total charts) before every chart
+    and once all are done. It can stop the conversion by raising, e.g. ConversionCancelled.
+
+    Notes that can't be converted are added to `diagnostics` per chart, or logged in
+    one summary per chart at the end if it isn't given.
+    """
+    report = diagnostics if diagnostics is not None else Diagnostics()
     bm = BeatMap()
     bm.version = "2.0.0"
     bm.song_name = sm.title
@@ -38,15 +258,25 @@ def beatmap_from_sm(sm: SMSong, sample_count: int = -1, sample_rate: int = 44100
         bpm_info.load_regions_from_events(bpm_events)
         bm.bpm_info = bpm_info
 
+    song_timing = bpm_timing = None
+    if sm.stops or sm.delays or sm.warps:
+        song_timing = sm.tempo_map(sample_rate)
+        bpm_timing = TempoMap(sm.bpm_changes, sample_rate=sample_rate)
+
     diff_set = DifficultyBeatmapSet()
-    for chart in sm.charts:
+    for chart_idx, chart in enumerate(sm.charts):
+        if progress is not None:
+            progress("convert", chart_idx, len(sm.charts))
+
+        if reuse is not None and chart_idx in reuse:
+            diff_set.diff_maps.append(reuse[chart_idx])
+            continue
+
+        scope = f"{chart.chart_type.value}:{chart.difficulty.value}"
         if chart.chart_type is not ChartType.DANCE_SINGLE:
-            logging.warning(
-                f"Skipping {chart.chart_type}:{chart.difficulty} "
-                f"because it is not dance-single."
-            )
+            report.add(scope, IssueKind.NOT_DANCE_SINGLE)
 
-        logging.info(f"Processing {chart.chart_type}:{chart.difficulty}")
+        logging.info(f"Processing {scope}")
 
         diff_map = DifficultyBeatmap()
         diff_map.version = "3.0.0"
@@ -54,26 +284,26 @@ def beatmap_from_sm(sm: SMSong, sample_count: int = -1, sample_rate: int = 44100
         diff_map.bpm_events = bpm_events[:]
         diff_map.filename = f"{diff_map.difficulty.difficulty}{diff_set.characteristic.value}.dat"
 
-        for sm_note in chart.notes:
-            beat = sm_note.tick / TICKS_PER_BEAT
-            if sm_note.note_type is NoteType.NORMAL:
-                diff_map.color_notes.append(ColorNote(
-                    beat,
-                    sm_note.column,
-                    0
-                ))
-            elif sm_note.note_type is NoteType.MINE:
-                diff_map.bomb_notes.append(BombNote(
-                    beat,
-                    sm_note.column,
-                    0
-                ))
+        color_beats, color_columns, bomb_beats, bomb_columns, ignored = classify_notes(
+            chart.notes, song_timing, bpm_timing
+        )
+        diff_map.color_notes = list(map(ColorNote._make, zip(color_beats, color_columns, *_COLOR_NOTE_REST)))
+        diff_map.bomb_notes = list(map(BombNote._make, zip(bomb_beats, bomb_columns, repeat(0))))
+
+        if hold_policy is not HoldPolicy.IGNORE:
+            ignored = _convert_holds(diff_map, chart.notes, ignored, hold_policy, report, scope)
+
+        for idx, beat, is_warped in ignored:
+            if is_warped:
+                report.add(scope, IssueKind.WARPED_NOTE, chart.notes.ticks[idx] / TICKS_PER_BEAT)
             else:
-                logging.warning(
-                    f"Ignoring note on beat {beat}: "
-                    f"note type {sm_note.note_type} is not supported"
-                )
+                report.add(scope, IssueKind.UNSUPPORTED_NOTE, beat, NoteType(chr(chart.notes.types[idx])))
 
         diff_set.diff_maps.append(diff_map)
     bm.difficulty_beatmap_sets.append(diff_set)
+
+    if diagnostics is None:
+        report.log()
+    if progress is not None:
+        progress("convert", len(sm.charts), len(sm.charts))
     return bm
@@ -0,0 +1,89 @@
+import logging
+from enum import Enum
+from typing import Any, Iterator, NamedTuple, Optional
+
+SONG_SCOPE = "song"
+
+
+class IssueKind(Enum):
+    IGNORED_TAG = "ignored tags"
+    NOT_UTF8 = "not UTF-8, metadata decoded as"
+    CHART_TIMING = "chart timing ignored in favor of the song's"
+    NOT_DANCE_SINGLE = "not a dance-single chart"
+    UNSUPPORTED_NOTE = "unsupported notes ignored"
+    WARPED_NOTE = "notes skipped by a warp ignored"
+    UNPAIRED_HOLD = "unpaired holds and rolls ignored"
+
+
+class Example(NamedTuple):
+    beat: Optional[float]
+    detail: Any
+
+    def __str__(self) -> str:
+        detail = self.detail.name if isinstance(self.detail, Enum) else self.detail
+        if self.beat is None:
+            return "" if detail is None else str(detail)
+        if detail is None:
+            return f"beat {self.beat:g}"
+        return f"{detail} on beat {self.beat:g}"
+
+
+class Diagnostics:
+    """Collects the problems found while loading and converting a song.
+
+    Problems are counted per scope (the song itself or one of its charts) and kind,
+    and the first `max_examples` of each are kept with their beat and details.
+    Adding a problem is cheap; nothing is formatted until a summary is asked for.
+    """
+
+    def __init__(self, max_examples: int = 5):
+        self.max_examples = max_examples
+        self.counts: dict[tuple[str, IssueKind], int] = {}
+        self.examples: dict[tuple[str, IssueKind], list[Example]] = {}
+
+    def add(self, scope: str, kind: IssueKind, beat: Optional[float] = None, detail: Any = None):
+        key = (scope, kind)
+        count = self.counts.get(key, 0)
+        self.counts[key] = count + 1
+        if count < self.max_examples:
+            self.examples.setdefault(key, []).append(Example(beat, detail))
+
+    def __len__(self) -> int:
+        """The total number of problems."""
+        return sum(self.counts.values())
+
+    def scopes(self) -> list[str]:
+        return list(dict.fromkeys(scope for scope, _ in self.counts))
+
+    def summary(self, scope: str) -> str:
+        """All problems of a scope on one line."""
+        parts = []
+        for (issue_scope, kind), count in self.counts.items():
+            if issue_scope != scope:
+                continue
+            examples = [str(example) for example in self.examples.get((scope, kind), []) if str(example)]
+            if not examples:
+                parts.append(f"{kind.value}: {count}")
+                continue
+            more = ", ..." if count > len(examples) else ""
+            parts.append(f"{kind.value}: {count} ({', '.join(examples)}{more})")
+        return f"{scope}: {'; '.join(parts)}"
+
+    def summaries(self) -> Iterator[str]:
+        for scope in self.scopes():
+            yield self.summary(scope)
+
+    def log(self, level: int = logging.WARNING):
+        """Log one record per scope, formatted only if the record is emitted."""
+        for scope in self.scopes():
+            logging.log(level, "%s", _LazySummary(self, scope))
+
+
+class _LazySummary:
+
+    def __init__(self, diagnostics: Diagnostics, scope: str):
+        self.diagnostics = diagnostics
+        self.scope = scope
+
+    def __str__(self) -> str:
+        return self.diagnostics.summary(self.scope)
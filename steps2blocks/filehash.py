@@ -0,0 +1,13 @@
+import hashlib
+from pathlib import Path
+
+CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path: Path) -> str:
+    """SHA-256 of a file's contents, as hex."""
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
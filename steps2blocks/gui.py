@@ -1,11 +1,31 @@
-import shutil
+import queue
 import sys
+import threading
 import tkinter as tk
 from pathlib import Path
 from tkinter import ttk, filedialog, messagebox
 
-from convert import beatmap_from_sm
-from smmap import load_sm
+from audio import place_audio
+from audioprobe import AudioInfo, probe_song_audio
+from convert import beatmap_from_sm, ConversionCancelled
+from diagnostics import Diagnostics
+from smmap import load_song
+
+POLL_INTERVAL = 50  # ms
+MAX_WARNING_LINES = 10
+
+STAGE_DESCRIPTIONS = {
+    "load": "Loading chart",
+    "convert": "Converting charts",
+    "save": "Writing files",
+    "audio": "Copying audio"
+}
+FAILURE_DESCRIPTIONS = {
+    "load": "An exception was raised while loading your Stepmania chart",
+    "convert": "An exception was raised during conversion",
+    "save": "An exception was raised while trying to save your converted map",
+    "audio": "An exception was raised while trying to copy the audio"
+}
 
 
 class FilePicker(ttk.Frame):
@@ -76,6 +96,59 @@ class IntPicker(ttk.Frame):
             return False
 
 
+class ConversionWorker(threading.Thread):
+    """Converts a song in the background, reporting back to the GUI through a queue.
+
+    Messages are ("progress", stage, done, total), ("done", warnings), ("cancelled",) and
+    ("failed", stage, exception), where warnings are one line per chart with problems.
+    """
+
+    def __init__(self, sm_path: str, output_path: str, fallback_audio_info: AudioInfo):
+        super().__init__(daemon=True)
+        self.sm_path = sm_path
+        self.output_path = output_path
+        self.fallback_audio_info = fallback_audio_info
+        self.messages = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.diagnostics = Diagnostics()
+        self.stage = "load"
+
+    def progress(self, stage: str, done: int, total: int) -> None:
+        if self.cancel_event.is_set():
+            raise ConversionCancelled()
+        self.stage = stage
+        self.messages.put(("progress", stage, done, total))
+
+    def run(self) -> None:
+        try:
+            self.progress("load", 0, 1)
+            # notes are only decoded once their chart is converted, so big files show progress sooner
+            sm_song = load_song(self.sm_path, lazy=True, diagnostics=self.diagnostics)
+            self.progress("load", 1, 1)
+            # probing the audio and the timing, before the first chart reports progress, are part of converting
+            self.stage = "convert"
+
+            audio_info = self.fallback_audio_info
+            sm_song_path = Path(self.sm_path).parent / sm_song.music_path
+            if sm_song.music_path:
+                audio_info = probe_song_audio(sm_song_path, audio_info)
+            bs_song = beatmap_from_sm(sm_song, audio_info.sample_count, audio_info.sample_rate,
+                                      progress=self.progress, diagnostics=self.diagnostics)
+
+            bs_song.save_to_disk(self.output_path, progress=self.progress)
+
+            self.progress("audio", 0, 1)
+            if sm_song.music_path and sm_song_path.is_file():
+                place_audio(sm_song_path, Path(self.output_path) / bs_song.song_filename)
+            self.progress("audio", 1, 1)
+        except ConversionCancelled:
+            self.messages.put(("cancelled",))
+        except Exception as e:
+            self.messages.put(("failed", self.stage, e))
+        else:
+            self.messages.put(("done", list(self.diagnostics.summaries())))
+
+
 class GUI(ttk.Frame):
 
     def __init__(self, *args, **kwargs):
@@ -84,16 +157,25 @@ class GUI(ttk.Frame):
         super().__init__(*args, **kwargs)
 
         self.sm_path_picker = FilePicker(self, "Stepmania file:", "load .sm",
-                                         (("sm4 chart", ".sm"),
+                                         (("stepmania chart", (".sm", ".ssc")),
+                                          ("sm4 chart", ".sm"),
+                                          ("sm5 chart", ".ssc"),
                                           ("any", ".*")))
         self.sample_rate_picker = IntPicker(self, "Sample rate:", "Hz", 44100)
         self.song_length_picker = IntPicker(self, "Song length:", "s", 600)
         self.convert_button = ttk.Button(self, text="Convert", command=self.do_convert)
+        self.progress_bar = ttk.Progressbar(self, orient="horizontal", mode="determinate")
+        self.status_value = tk.StringVar(self)
+        self.status_label = ttk.Label(self, textvariable=self.status_value)
+        self.cancel_button = ttk.Button(self, text="Cancel", command=self.do_cancel, state="disabled")
 
         self.sm_path_picker.grid(column=0, row=0, columnspan=5, sticky="we")
         self.sample_rate_picker.grid(column=0, row=5, sticky="w")
         self.song_length_picker.grid(column=1, row=5, sticky="w")
         self.convert_button.grid(column=4, row=5, sticky="e")
+        self.progress_bar.grid(column=0, row=6, columnspan=5, sticky="we")
+        self.status_label.grid(column=0, row=7, columnspan=4, sticky="w")
+        self.cancel_button.grid(column=4, row=7, sticky="e")
 
         self.rowconfigure("all", pad=5)
         self.columnconfigure("all", pad=5)
@@ -102,48 +184,76 @@ class GUI(ttk.Frame):
         self.master.bind("<Control-o>", lambda e: self.sm_path_picker.button.invoke())
         self.master.bind("<Control-s>", lambda e: self.convert_button.invoke())
 
+        self.worker = None
+
     def do_convert(self) -> None:
         failure_str = "Conversion failed"
+        if self.worker is not None:
+            return
         sm_path = self.sm_path_picker.path_value.get()
         if not sm_path:
-            messagebox.showerror(failure_str, "No .sm file selected!")
-            return
-
-        try:
-            sm_song = load_sm(sm_path)
-        except Exception as e:
-            messagebox.showerror(failure_str, f"An exception was raised while loading your Stepmania chart:\n{e}")
-            return
-
-        sample_rate = int(self.sample_rate_picker.int_value.get())
-        sample_count = int(self.song_length_picker.int_value.get()) * sample_rate
-        try:
-            bs_song = beatmap_from_sm(sm_song, sample_count, sample_rate)
-        except Exception as e:
-            messagebox.showerror(failure_str, f"An exception was raised during conversion:\n{e}")
+            messagebox.showerror(failure_str, "No .sm or .ssc file selected!")
             return
 
         output_path = filedialog.askdirectory(mustexist=False, title="Choose where to save your Beat Saber map")
         if not output_path:
             return
 
+        sample_rate = int(self.sample_rate_picker.int_value.get())
+        fallback_audio_info = AudioInfo(sample_rate, int(self.song_length_picker.int_value.get()) * sample_rate)
+
+        self.worker = ConversionWorker(sm_path, output_path, fallback_audio_info)
+        self.convert_button.configure(state="disabled")
+        self.cancel_button.configure(state="normal")
+        self.worker.start()
+        self.after(POLL_INTERVAL, self.poll_worker)
+
+    def do_cancel(self) -> None:
+        if self.worker is not None:
+            self.worker.cancel_event.set()
+            self.cancel_button.configure(state="disabled")
+            self.status_value.set("Cancelling...")
+
+    def poll_worker(self) -> None:
+        finished = None
         try:
-            bs_song.save_to_disk(output_path)
-        except Exception as e:
-            messagebox.showerror(failure_str, f"An exception was raised while trying to save your converted map:\n{e}")
-            return
-
-        try:
-            sm_song_path = Path(sm_path).parent / sm_song.music_path
-            if sm_song_path.is_file():
-                bs_song_path = Path(output_path) / bs_song.song_filename
-                if not bs_song_path.exists():
-                    shutil.copy(sm_song_path, bs_song_path)
-        except Exception as e:
-            messagebox.showerror(failure_str, f"An exception was raised while trying to copy the audio:\n{e}")
+            while True:
+                message = self.worker.messages.get_nowait()
+                if message[0] == "progress":
+                    _, stage, done, total = message
+                    if not self.worker.cancel_event.is_set():
+                        self.status_value.set(f"{STAGE_DESCRIPTIONS[stage]} ({done}/{total})")
+                    self.progress_bar.configure(maximum=max(total, 1), value=done)
+                else:
+                    finished = message
+        except queue.Empty:
+            pass
+
+        if finished is None:
+            self.after(POLL_INTERVAL, self.poll_worker)
             return
 
-        messagebox.showinfo("Success!", "Chart has been converted")
+        self.worker = None
+        self.convert_button.configure(state="normal")
+        self.cancel_button.configure(state="disabled")
+        self.progress_bar.configure(value=0)
+
+        if finished[0] == "done":
+            self.status_value.set("Done")
+            warnings = finished[1]
+            if not warnings:
+                messagebox.showinfo("Success!", "Chart has been converted")
+                return
+            if len(warnings) > MAX_WARNING_LINES:
+                warnings = warnings[:MAX_WARNING_LINES] + [f"and {len(warnings) - MAX_WARNING_LINES} more"]
+            messagebox.showwarning("Success!", "Chart has been converted, with some problems:\n\n"
+                                   + "\n\n".join(warnings))
+        elif finished[0] == "cancelled":
+            self.status_value.set("Cancelled")
+        else:
+            _, stage, e = finished
+            self.status_value.set("Failed")
+            messagebox.showerror("Conversion failed", f"{FAILURE_DESCRIPTIONS[stage]}:\n{e}")
 
 
 def open_gui():
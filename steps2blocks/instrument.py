@@ -0,0 +1,181 @@
+"""Opt-in timing and memory instrumentation of the conversion stages.
+
+Stages are marked with the `stage` decorator or the `measure` context manager. While
+instrumentation is disabled, which is the default, both only cost a flag check.
+Once enabled, every stage records its number of calls, wall and CPU time, a count
+of the items it handled (notes, files, ...) and, if memory tracing is on, the peak
+traced memory during the stage relative to when it started.
+
+Nested stages are measured separately; the peak of a stage includes the peaks of
+the stages nested in it. Memory is traced for the whole process, so the peaks of
+stages running concurrently in different threads include each other's memory.
+"""
+import functools
+import json
+import threading
+import time
+import tracemalloc
+from typing import Any, Callable, Optional, TextIO
+
+_enabled = False
+_trace_memory = False
+_started_tracing = False
+_lock = threading.Lock()
+_local = threading.local()
+# stage name -> [calls, wall, cpu, items, peak memory]
+_stats: dict[str, list] = {}
+
+
+def enable(trace_memory: bool = True):
+    """Start recording stages. Tracing memory slows everything down considerably."""
+    global _enabled, _trace_memory, _started_tracing
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracing = True
+    _enabled = True
+
+
+def disable():
+    global _enabled, _trace_memory, _started_tracing
+    _enabled = False
+    if _started_tracing:
+        tracemalloc.stop()
+    _trace_memory = _started_tracing = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+class _Measurement:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.child_peak = 0
+
+    def add(self, items: int):
+        """Count items handled by this stage."""
+        self.items += items
+
+    def __enter__(self) -> "_Measurement":
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        if _trace_memory:
+            self.start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.start_cpu = time.thread_time()
+        self.start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.thread_time() - self.start_cpu
+        peak = 0
+        if _trace_memory and tracemalloc.is_tracing():
+            absolute_peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            peak = absolute_peak - self.start_memory
+        else:
+            absolute_peak = 0
+
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            stack[-1].child_peak = max(stack[-1].child_peak, absolute_peak)
+
+        with _lock:
+            stats = _stats.setdefault(self.name, [0, 0.0, 0.0, 0, 0])
+            stats[0] += 1
+            stats[1] += wall
+            stats[2] += cpu
+            stats[3] += self.items
+            stats[4] = max(stats[4], peak)
+
+
+class _NoMeasurement:
+
+    def add(self, items: int):
+        pass
+
+    def __enter__(self) -> "_NoMeasurement":
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_MEASUREMENT = _NoMeasurement()
+
+
+def measure(name: str):
+    """Context manager measuring the stage `name`, call `add()` on it to count items."""
+    if not _enabled:
+        return _NO_MEASUREMENT
+    return _Measurement(name)
+
+
+def stage(name: str, count: Optional[Callable[[Any], int]] = None):
+    """Decorator measuring every call of a function as the stage `name`.
+
+    `count` gets the function's return value and returns the number of items it handled.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            with _Measurement(name) as measurement:
+                result = fn(*args, **kwargs)
+                if count is not None:
+                    measurement.add(count(result))
+                return result
+        return wrapper
+    return decorator
+
+
+def snapshot(reset: bool = False) -> dict[str, Any]:
+    """The stats recorded so far, as a JSON serializable dict."""
+    with _lock:
+        stages = {
+            name: {"calls": calls, "wall": wall, "cpu": cpu, "items": items, "peak_memory": peak}
+            for name, (calls, wall, cpu, items, peak) in _stats.items()
+        }
+        if reset:
+            _stats.clear()
+    return {"memory_traced": _trace_memory, "stages": stages}
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def merge(snapshots: list[dict[str, Any]]) -> dict[str, Any]:
+    """Combine snapshots, e.g. from several worker processes, into one."""
+    stages = {}
+    for snap in snapshots:
+        for name, stats in snap["stages"].items():
+            merged = stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "items": 0, "peak_memory": 0})
+            for key in ("calls", "wall", "cpu", "items"):
+                merged[key] += stats[key]
+            merged["peak_memory"] = max(merged["peak_memory"], stats["peak_memory"])
+    return {"memory_traced": any(snap["memory_traced"] for snap in snapshots), "stages": stages}
+
+
+def write_report(out: TextIO, snap: Optional[dict[str, Any]] = None):
+    """Write a snapshot, by default of the current stats, as a JSON report."""
+    json.dump(snap if snap is not None else snapshot(), out, indent=2)
+
+
+def print_report(out: TextIO, snap: Optional[dict[str, Any]] = None):
+    """Print a snapshot, by default of the current stats, as a table sorted by wall time."""
+    snap = snap if snap is not None else snapshot()
+    stages = sorted(snap["stages"].items(), key=lambda item: item[1]["wall"], reverse=True)
+    print(f"{'stage':<40} {'calls':>7} {'wall':>9} {'cpu':>9} {'items':>10} {'peak':>10}", file=out)
+    for name, stats in stages:
+        peak = f"{stats['peak_memory'] / 1024:7.0f}KiB" if snap["memory_traced"] else f"{'-':>10}"
+        print(f"{name:<40} {stats['calls']:>7} {stats['wall']:8.3f}s {stats['cpu']:8.3f}s "
+              f"{stats['items']:>10} {peak}", file=out)
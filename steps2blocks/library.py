@@ -0,0 +1,216 @@
+import logging
+import os
+import sqlite3
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+from diagnostics import Diagnostics
+from smmap import load_song
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    sub_title TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    credit TEXT NOT NULL,
+    music_path TEXT NOT NULL,
+    min_bpm REAL,
+    max_bpm REAL
+);
+CREATE TABLE IF NOT EXISTS charts (
+    song_id INTEGER NOT NULL REFERENCES songs (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    chart_type TEXT NOT NULL,
+    description TEXT NOT NULL,
+    difficulty TEXT NOT NULL,
+    meter INTEGER NOT NULL,
+    PRIMARY KEY (song_id, position)
+);
+CREATE INDEX IF NOT EXISTS charts_by_difficulty ON charts (difficulty, meter);
+"""
+
+
+class IndexStats(NamedTuple):
+    added: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    removed: int = 0
+    failed: int = 0
+
+
+def scan_songs(root: Path) -> Iterator[tuple[Path, os.stat_result]]:
+    """Every .sm and .ssc file under `root`, with its stat, preferring the .ssc file of a song that has both.
+
+    Symlinked directories are followed, every directory is scanned once however many links lead to it.
+    """
+    pending = [root]
+    visited = set()  # real paths of the directories scanned, so symlinks can't make it go around in circles
+    while pending:
+        directory = pending.pop()
+        real_path = os.path.realpath(directory)
+        if real_path in visited:
+            continue
+        visited.add(real_path)
+        songs = {}
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        pending.append(Path(entry.path))
+                        continue
+                    stem, ext = os.path.splitext(entry.name)
+                    ext = ext.lower()
+                    if ext in (".sm", ".ssc") and entry.is_file():
+                        songs[(stem, ext)] = entry
+        except OSError as e:
+            logging.warning(f"Could not scan {directory}: {e}")
+            continue
+        for (stem, ext), entry in sorted(songs.items()):
+            if ext == ".sm" and (stem, ".ssc") in songs:
+                # same as StepMania, prefer the newer format
+                continue
+            try:
+                yield Path(entry.path), entry.stat()
+            except OSError:
+                continue
+
+
+class Library:
+    """An SQLite index of the songs and charts in song folders, for searching them without parsing anything.
+
+    Indexing only reads the metadata and the chart headers of every file, its note data
+    is never decoded. Files that haven't changed since they were last indexed, by their
+    size and mtime, are skipped, and songs whose files are gone are dropped.
+    """
+
+    def __init__(self, db_path: Path, encoding: Optional[str] = None, create: bool = True):
+        """Open the library at `db_path`, creating it unless `create` is False, then a missing one raises
+        sqlite3.OperationalError."""
+        self.encoding = encoding
+        if create:
+            self.db = sqlite3.connect(db_path)
+        else:
+            self.db = sqlite3.connect(f"{Path(db_path).resolve().as_uri()}?mode=rw", uri=True)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        if create:
+            self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self) -> "Library":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _index_file(self, path: Path, stat: os.stat_result, song_id: Optional[int]):
+        sm_song = load_song(str(path), lazy=True, diagnostics=Diagnostics(), encoding=self.encoding)
+        bpms = [bpm_change.new_bpm for bpm_change in sm_song.bpm_changes]
+        row = (str(path), stat.st_size, stat.st_mtime_ns, sm_song.title, sm_song.sub_title, sm_song.artist,
+               sm_song.credit, sm_song.music_path, min(bpms, default=None), max(bpms, default=None))
+        if song_id is None:
+            song_id = self.db.execute(
+                "INSERT INTO songs (path, size, mtime_ns, title, sub_title, artist, credit, music_path, min_bpm, "
+                "max_bpm) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row
+            ).lastrowid
+        else:
+            self.db.execute(
+                "UPDATE songs SET path = ?, size = ?, mtime_ns = ?, title = ?, sub_title = ?, artist = ?, "
+                "credit = ?, music_path = ?, min_bpm = ?, max_bpm = ? WHERE id = ?", (*row, song_id)
+            )
+            self.db.execute("DELETE FROM charts WHERE song_id = ?", (song_id,))
+        self.db.executemany(
+            "INSERT INTO charts (song_id, position, chart_type, description, difficulty, meter) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(song_id, position, chart.chart_type.value, chart.description, chart.difficulty.value, chart.meter)
+             for position, chart in enumerate(sm_song.charts)]
+        )
+
+    def index(self, roots: Iterable[Path]) -> IndexStats:
+        """Bring the index up to date with the song folders under `roots`, in a single transaction."""
+        added = updated = unchanged = removed = failed = 0
+        with self.db:
+            for root in roots:
+                root = root.resolve()
+                known = {path: (song_id, size, mtime_ns) for song_id, path, size, mtime_ns in self.db.execute(
+                    "SELECT id, path, size, mtime_ns FROM songs WHERE path >= ? AND path < ?",
+                    _prefix_range(root)
+                )}
+                for path, stat in scan_songs(root):
+                    song_id, size, mtime_ns = known.pop(str(path), (None, None, None))
+                    if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                        unchanged += 1
+                        continue
+                    try:
+                        self._index_file(path, stat, song_id)
+                    except Exception as e:
+                        logging.warning(f"Could not index {path}: {e}")
+                        failed += 1
+                        continue
+                    if song_id is None:
+                        added += 1
+                    else:
+                        updated += 1
+
+                # left over are the songs that are gone, or that a .ssc file now takes the place of
+                self.db.executemany("DELETE FROM songs WHERE id = ?", [(song_id,) for song_id, _, _ in known.values()])
+                removed += len(known)
+        return IndexStats(added, updated, unchanged, removed, failed)
+
+    def query(
+            self,
+            title: Optional[str] = None,
+            artist: Optional[str] = None,
+            min_bpm: Optional[float] = None,
+            max_bpm: Optional[float] = None,
+            chart_type: Optional[str] = None,
+            difficulty: Optional[str] = None,
+            min_meter: Optional[int] = None,
+            max_meter: Optional[int] = None
+    ) -> list[Path]:
+        """Paths of the songs matching every given condition, sorted.
+
+        `title` and `artist` match case-insensitive substrings (the title includes the
+        subtitle). A BPM range matches songs whose BPMs all lie in it. The chart conditions
+        match songs with at least one chart meeting all of them at once.
+        """
+        conditions = []
+        params = []
+        if title is not None:
+            conditions.append("instr(lower(title || ' ' || sub_title), lower(?)) > 0")
+            params.append(title)
+        if artist is not None:
+            conditions.append("instr(lower(artist), lower(?)) > 0")
+            params.append(artist)
+        if min_bpm is not None:
+            conditions.append("min_bpm >= ?")
+            params.append(min_bpm)
+        if max_bpm is not None:
+            conditions.append("max_bpm <= ?")
+            params.append(max_bpm)
+
+        chart_conditions = []
+        for column, operator, value in (("chart_type", "=", chart_type), ("difficulty", "=", difficulty),
+                                        ("meter", ">=", min_meter), ("meter", "<=", max_meter)):
+            if value is not None:
+                chart_conditions.append(f"{column} {operator} ?")
+                params.append(value)
+        if chart_conditions:
+            conditions.append("EXISTS (SELECT 1 FROM charts WHERE song_id = songs.id AND "
+                              f"{' AND '.join(chart_conditions)})")
+
+        sql = "SELECT path FROM songs"
+        if conditions:
+            sql += f" WHERE {' AND '.join(conditions)}"
+        return [Path(path) for path, in self.db.execute(sql + " ORDER BY path", params)]
+
+
+def _prefix_range(root: Path) -> tuple[str, str]:
+    """Bounds of the paths under `root`, as strings, for an indexed range query."""
+    prefix = str(root).rstrip(os.sep) + os.sep
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
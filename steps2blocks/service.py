@@ -0,0 +1,287 @@
+"""A long-running local conversion service, so callers don't pay for starting Python on every song.
+
+It speaks just enough HTTP/1.1 over TCP or a Unix socket:
+
+- `POST /convert` with a .sm file as the body (`?format=ssc` for a .ssc file) answers
+  with the converted map as a zip. With a JSON body `{"path": ...}` the song is read
+  from that path instead and its audio is included in the zip; adding `"output": ...`
+  writes the map to that directory like `batch` does and answers with JSON.
+- `GET /stats` answers with the queue depth, counts and conversion latencies as JSON.
+
+Conversions run in a pool of worker processes that stay warm between requests. At most
+`workers` run at once and `max_queue` more wait; requests beyond that get a 503, so
+callers can back off.
+"""
+import asyncio
+import io
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, NamedTuple, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from batch import BatchJob, ConversionSettings, convert_song
+from convert import beatmap_from_sm
+from diagnostics import Diagnostics
+from smmap import load_sm_from_bytes, load_ssc_from_bytes, load_song
+
+MAX_BODY_SIZE = 64 << 20
+LATENCY_WINDOW = 1000  # latest conversions the latency stats are computed over
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 411: "Length Required",
+            413: "Payload Too Large", 422: "Unprocessable Entity", 500: "Internal Server Error",
+            503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Response(NamedTuple):
+    status: int
+    content_type: str
+    content: bytes
+    warnings: tuple[str, ...] = ()  # of the conversion, sent JSON encoded in an X-Conversion-Warnings header
+
+
+class _SongFailed(Exception):
+    """convert_song reported a failure, the message is its error."""
+
+
+def _convert_upload(data: bytes, is_ssc: bool, settings: ConversionSettings) -> tuple[bytes, tuple[str, ...]]:
+    diagnostics = Diagnostics()
+    load = load_ssc_from_bytes if is_ssc else load_sm_from_bytes
+    sm_song = load(data, diagnostics=diagnostics, encoding=settings.encoding)
+    audio_info = settings.audio_info(None)
+    bs_song = beatmap_from_sm(sm_song, audio_info.sample_count, audio_info.sample_rate, settings.hold_policy,
+                              diagnostics=diagnostics)
+    out = io.BytesIO()
+    bs_song.save_to_zip(out)
+    return out.getvalue(), tuple(diagnostics.summaries())
+
+
+def _convert_path(sm_path: Path, settings: ConversionSettings) -> tuple[bytes, tuple[str, ...]]:
+    diagnostics = Diagnostics()
+    sm_song = load_song(str(sm_path), diagnostics=diagnostics, encoding=settings.encoding)
+    audio_path = sm_path.parent / sm_song.music_path if sm_song.music_path else None
+    audio_info = settings.audio_info(audio_path)
+    bs_song = beatmap_from_sm(sm_song, audio_info.sample_count, audio_info.sample_rate, settings.hold_policy,
+                              diagnostics=diagnostics)
+    out = io.BytesIO()
+    bs_song.save_to_zip(out, audio_path if audio_path is not None and audio_path.is_file() else None)
+    return out.getvalue(), tuple(diagnostics.summaries())
+
+
+def _convert_to_output(job: BatchJob, settings: ConversionSettings) -> tuple[str, ...]:
+    result = convert_song(job, settings)
+    if result.error is not None:
+        raise _SongFailed(result.error)
+    return result.warnings
+
+
+class ConversionService:
+    """Converts songs for HTTP clients, see the module docstring for the endpoints."""
+
+    def __init__(
+            self,
+            settings: ConversionSettings = ConversionSettings(),
+            workers: int = 1,
+            max_queue: int = 16
+    ):
+        self.settings = settings
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.latencies: deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def stats(self) -> dict[str, Any]:
+        latencies = sorted(self.latencies)
+        latency = None
+        if latencies:
+            latency = {
+                "mean": sum(latencies) / len(latencies),
+                "p50": latencies[len(latencies) // 2],
+                "p95": latencies[min(len(latencies) - 1, len(latencies) * 95 // 100)],
+                "max": latencies[-1]
+            }
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queued": self.queued,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "latency": latency  # seconds from receiving a request to having its result
+        }
+
+    async def run_conversion(self, fn, *args) -> Any:
+        """Run `fn(*args)` in a worker process once a slot is free, or reject it if too many are waiting."""
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise HTTPError(503, "too many conversions queued, try again later")
+        start = time.perf_counter()
+        self.queued += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.queued -= 1
+        self.running += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        except Exception as e:
+            self.failed += 1
+            raise HTTPError(422, str(e) if isinstance(e, _SongFailed) else f"{type(e).__name__}: {e}")
+        finally:
+            self.running -= 1
+            self.slots.release()
+        self.completed += 1
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    async def convert(self, query: dict[str, list[str]], headers: dict[str, str], body: bytes) -> Response:
+        if not headers.get("content-type", "").startswith("application/json"):
+            is_ssc = query.get("format", ["sm"])[0] == "ssc"
+            zip_data, warnings = await self.run_conversion(_convert_upload, body, is_ssc, self.settings)
+            return Response(200, "application/zip", zip_data, warnings)
+
+        try:
+            request = json.loads(body)
+            sm_path = Path(request["path"])
+            output = request.get("output")
+        except (ValueError, KeyError, TypeError) as e:
+            raise HTTPError(400, f"expected a JSON object with a path: {e}")
+        if not sm_path.is_file():
+            raise HTTPError(404, f"{sm_path} is not a file")
+
+        if output is None:
+            zip_data, warnings = await self.run_conversion(_convert_path, sm_path, self.settings)
+            return Response(200, "application/zip", zip_data, warnings)
+
+        output_path = Path(output)
+        warnings = await self.run_conversion(_convert_to_output, BatchJob(sm_path, output_path), self.settings)
+        if self.settings.zip_output:
+            output_path = output_path.with_name(f"{output_path.name}.zip")
+        response = {"output": str(output_path), "warnings": list(warnings)}
+        return Response(200, "application/json", json.dumps(response).encode("utf-8"), warnings)
+
+    async def route(self, method: str, target: str, headers: dict[str, str], body: bytes) -> Response:
+        url = urlsplit(target)
+        if url.path == "/convert":
+            if method != "POST":
+                raise HTTPError(405, "use POST")
+            return await self.convert(parse_qs(url.query), headers, body)
+        if url.path == "/stats":
+            if method != "GET":
+                raise HTTPError(405, "use GET")
+            return Response(200, "application/json", json.dumps(self.stats()).encode("utf-8"))
+        raise HTTPError(404, f"no such endpoint: {url.path}")
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    request = await _read_request(reader)
+                except HTTPError as e:
+                    await _write_response(writer, _error_response(e.status, str(e)), False)
+                    return
+                if request is None:
+                    return
+                method, target, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    response = await self.route(method, target, headers, body)
+                except HTTPError as e:
+                    response = _error_response(e.status, str(e))
+                except Exception as e:
+                    logging.exception(f"Failed to handle {method} {target}")
+                    response = _error_response(500, f"{type(e).__name__}: {e}")
+                await _write_response(writer, response, keep_alive)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # the server is shutting down, end the connection quietly
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000, unix_path: Optional[Path] = None):
+        """Serve on `host:port`, or on a Unix socket at `unix_path` if it's given, until cancelled."""
+        self.slots = asyncio.Semaphore(self.workers)
+        with ProcessPoolExecutor(self.workers) as self.executor:
+            if unix_path is not None:
+                server = await asyncio.start_unix_server(self.handle_connection, unix_path)
+            else:
+                server = await asyncio.start_server(self.handle_connection, host, port)
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                if unix_path is not None:
+                    unix_path.unlink(missing_ok=True)
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[tuple[str, str, dict[str, str], bytes]]:
+    """Read one request, returns None if the client closed the connection instead."""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise HTTPError(400, "incomplete request")
+    except asyncio.LimitOverrunError:
+        raise HTTPError(400, "request head too large")
+
+    request_line, *header_lines = head.decode("latin-1").rstrip("\r\n").split("\r\n")
+    try:
+        method, target, _ = request_line.split(" ")
+    except ValueError:
+        raise HTTPError(400, f"malformed request line: {request_line!r}")
+    headers = {}
+    for line in header_lines:
+        name, sep, value = line.partition(":")
+        if not sep:
+            raise HTTPError(400, f"malformed header: {line!r}")
+        headers[name.strip().lower()] = value.strip()
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HTTPError(411, "send a Content-Length instead of a chunked body")
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPError(400, "malformed Content-Length")
+    if length < 0:
+        raise HTTPError(400, "malformed Content-Length")
+    if length > MAX_BODY_SIZE:
+        raise HTTPError(413, f"bodies are limited to {MAX_BODY_SIZE} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return method, target, headers, body
+
+
+def _error_response(status: int, message: str) -> Response:
+    return Response(status, "application/json", json.dumps({"error": message}).encode("utf-8"))
+
+
+async def _write_response(writer: asyncio.StreamWriter, response: Response, keep_alive: bool):
+    head = (f"HTTP/1.1 {response.status} {_REASONS[response.status]}\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Length: {len(response.content)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n")
+    if response.warnings:
+        head += f"X-Conversion-Warnings: {json.dumps(response.warnings)}\r\n"
+    if response.status == 503:
+        head += "Retry-After: 1\r\n"
+    writer.write(head.encode("latin-1") + b"\r\n" + response.content)
+    await writer.drain()
@@ -0,0 +1,201 @@
+"""Binary cache of parsed songs, much faster to load than parsing their .sm or .ssc files again.
+
+A cache file starts with MAGIC, the format version and the length of a JSON header,
+as `<8sHI`. The header holds what the cache was made from (the source file's size,
+mtime and SHA-256, and the encoding it was parsed with), the song's metadata and
+timing and, per chart, its header fields and number of notes. The notes of every
+chart follow in header order, as three packed little-endian arrays: ticks (int32),
+columns (int8) and types (uint8), each read back with a single `frombytes`.
+"""
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from pathlib import Path
+from typing import Any, Optional
+
+from diagnostics import Diagnostics
+from filehash import file_digest
+from smmap import SMSong, SMChart, NoteArray, BPMChange, Stop, Warp, ChartType, Difficulty, load_song
+
+MAGIC = b"S2BSONG\0"
+# Bump whenever the layout of a cache file changes, older files are then parsed again.
+FORMAT_VERSION = 1
+_PREAMBLE = struct.Struct("<8sHI")
+_NOTE_COLUMNS = (("ticks", "i"), ("columns", "b"), ("types", "B"))
+_NOTE_SIZE = sum(array(typecode).itemsize for _, typecode in _NOTE_COLUMNS)
+
+_METADATA_FIELDS = ("title", "sub_title", "artist", "credit", "music_path", "start_offset", "sample_start",
+                    "sample_duration")
+
+
+def source_info(source_path: Path, encoding: Optional[str]) -> dict[str, Any]:
+    """What a cache records of the file it's made from, to tell later whether it's still fresh."""
+    stat = source_path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_digest(source_path),
+            "encoding": encoding}
+
+
+def _is_fresh(source: dict[str, Any], source_path: Path, encoding: Optional[str]) -> bool:
+    """Whether a cache made from `source` still matches the file, by its size and mtime or else its contents."""
+    if source["encoding"] != encoding:
+        return False
+    try:
+        stat = source_path.stat()
+    except OSError:
+        return False
+    if stat.st_size != source["size"]:
+        return False
+    # e.g. after a checkout, the file was touched but might not have changed
+    return stat.st_mtime_ns == source["mtime_ns"] or file_digest(source_path) == source["sha256"]
+
+
+def _column_bytes(column: array) -> bytes:
+    if sys.byteorder == "big" and column.itemsize > 1:
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def save_cache(
+        sm_song: SMSong,
+        cache_path: Path,
+        source_path: Path,
+        encoding: Optional[str] = None,
+        source: Optional[dict[str, Any]] = None
+):
+    """Write `sm_song`, parsed from `source_path` with `encoding`, to a cache file.
+
+    `source` is what `source_info()` returned for the file right before it was parsed, the
+    file is looked at again if it's not given. Charts loaded lazily are decoded first. The
+    file is written next to `cache_path` and moved into place, so readers never see a
+    partial cache.
+    """
+    header = {
+        "source": source if source is not None else source_info(source_path, encoding),
+        "song": {name: getattr(sm_song, name) for name in _METADATA_FIELDS},
+        "timing": {
+            "bpm_changes": sm_song.bpm_changes,
+            "stops": sm_song.stops,
+            "delays": sm_song.delays,
+            "warps": sm_song.warps
+        },
+        "charts": [
+            {
+                "chart_type": chart.chart_type.value,
+                "description": chart.description,
+                "difficulty": chart.difficulty.value,
+                "meter": chart.meter,
+                "notes": len(chart.notes)
+            }
+            for chart in sm_song.charts
+        ]
+    }
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=cache_path.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            for chart in sm_song.charts:
+                for name, _ in _NOTE_COLUMNS:
+                    f.write(_column_bytes(getattr(chart.notes, name)))
+        os.replace(tmp_name, cache_path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def load_cache(
+        cache_path: Path,
+        source_path: Optional[Path] = None,
+        encoding: Optional[str] = None
+) -> Optional[SMSong]:
+    """Read a song from a cache file.
+
+    Returns None if there is no cache, it's of another format version or, if `source_path`
+    is given, it's stale: the file changed since, or was parsed with another encoding.
+    Raises ValueError if the cache is corrupt.
+    """
+    try:
+        with cache_path.open("rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < _PREAMBLE.size:
+        return None
+    magic, version, header_size = _PREAMBLE.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        return None
+    offset = _PREAMBLE.size + header_size
+    header = json.loads(data[_PREAMBLE.size:offset])
+    if source_path is not None and not _is_fresh(header["source"], source_path, encoding):
+        return None
+    if len(data) != offset + sum(chart["notes"] for chart in header["charts"]) * _NOTE_SIZE:
+        raise ValueError(f"{cache_path} is truncated")
+
+    sm_song = SMSong()
+    for name, value in header["song"].items():
+        setattr(sm_song, name, value)
+    timing = header["timing"]
+    sm_song.bpm_changes = list(map(BPMChange._make, timing["bpm_changes"]))
+    sm_song.stops = list(map(Stop._make, timing["stops"]))
+    sm_song.delays = list(map(Stop._make, timing["delays"]))
+    sm_song.warps = list(map(Warp._make, timing["warps"]))
+
+    view = memoryview(data)
+    for chart_header in header["charts"]:
+        sm_chart = SMChart()
+        sm_chart.chart_type = ChartType(chart_header["chart_type"])
+        sm_chart.description = chart_header["description"]
+        sm_chart.difficulty = Difficulty(chart_header["difficulty"])
+        sm_chart.meter = chart_header["meter"]
+
+        notes = NoteArray()
+        for name, _ in _NOTE_COLUMNS:
+            column = getattr(notes, name)
+            end = offset + chart_header["notes"] * column.itemsize
+            column.frombytes(view[offset:end])
+            if sys.byteorder == "big":
+                column.byteswap()
+            offset = end
+        sm_chart.notes = notes
+        sm_song.charts.append(sm_chart)
+    return sm_song
+
+
+def cache_path_for(cache_dir: Path, source_path: Path) -> Path:
+    """Where the cache of a source file goes in a cache directory, by a hash of the file's absolute path."""
+    key = hashlib.sha256(str(source_path.resolve()).encode("utf-8")).hexdigest()
+    return cache_dir / key[:2] / f"{key}.smc"
+
+
+def load_song_cached(
+        source_path: Path,
+        cache_dir: Path,
+        diagnostics: Optional[Diagnostics] = None,
+        encoding: Optional[str] = None
+) -> SMSong:
+    """Load a song from its cache in `cache_dir` if that's fresh, else parse it and cache it.
+
+    Problems are only added to `diagnostics` when the file is parsed, a cached song reports none.
+    """
+    cache_path = cache_path_for(cache_dir, source_path)
+    try:
+        sm_song = load_cache(cache_path, source_path, encoding)
+    except (ValueError, KeyError, TypeError):
+        # a corrupt cache, e.g. a truncated file
+        sm_song = None
+    if sm_song is not None:
+        return sm_song
+
+    # taken first, so a file saved while it's parsed doesn't leave a cache that looks fresh but holds the old notes
+    source = source_info(source_path, encoding)
+    sm_song = load_song(str(source_path), diagnostics=diagnostics, encoding=encoding)
+    save_cache(sm_song, cache_path, source_path, encoding, source)
+    return sm_song
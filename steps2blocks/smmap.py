@@ -1,7 +1,16 @@
+import codecs
+import hashlib
 import logging
+import mmap
+import re
+from array import array
+from contextlib import contextmanager
 from enum import Enum
-from io import StringIO
-from typing import NamedTuple
+from typing import AnyStr, NamedTuple, Optional, Iterable, Iterator, Union
+
+import instrument
+from diagnostics import Diagnostics, IssueKind, SONG_SCOPE
+from timing import TempoMap
 
 TICKS_PER_MEASURE = 192
 BEATS_PER_MEASURE = 4
@@ -13,6 +22,17 @@ class BPMChange(NamedTuple):
     new_bpm: float
 
 
+class Stop(NamedTuple):
+    """A stop or a delay."""
+    beat: float
+    duration: float  # seconds
+
+
+class Warp(NamedTuple):
+    beat: float
+    length: float  # beats
+
+
 class ChartType(Enum):
     DANCE_SINGLE = "dance-single"
     UNKNOWN = "???"  # TODO
@@ -49,19 +69,112 @@ class Note(NamedTuple):
     note_type: NoteType
 
 
+_NOTE_TYPE_BY_CODE = {ord(note_type.value): note_type for note_type in NoteType}
+_NOTE_CODE_BY_CHAR = {note_type.value: ord(note_type.value) for note_type in NoteType}
+# a note's code is the byte it's written as
+_NOTE_CODES = frozenset(_NOTE_TYPE_BY_CODE)
+_EMPTY_NOTE_CODE = ord("0")
+
+
+class NoteArray:
+    """Structure-of-arrays storage for the notes of a chart.
+
+    Ticks, columns and note types live in three parallel arrays, note types
+    coded as the byte of their character in the chart. Indexing and iteration
+    produce `Note` tuples, so it can be used in place of a `list[Note]`.
+    """
+    __slots__ = ("ticks", "columns", "types")
+
+    def __init__(self, notes: Iterable[Note] = ()):
+        self.ticks = array("i")
+        self.columns = array("b")
+        self.types = array("B")
+        for note in notes:
+            self.append(note)
+
+    def append(self, note: Note):
+        self.ticks.append(note.tick)
+        self.columns.append(note.column)
+        self.types.append(ord(note.note_type.value))
+
+    def __len__(self) -> int:
+        return len(self.ticks)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            sliced = NoteArray()
+            sliced.ticks = self.ticks[idx]
+            sliced.columns = self.columns[idx]
+            sliced.types = self.types[idx]
+            return sliced
+        return Note(self.ticks[idx], self.columns[idx], _NOTE_TYPE_BY_CODE[self.types[idx]])
+
+    def __iter__(self) -> Iterator[Note]:
+        return map(Note, self.ticks, self.columns, map(_NOTE_TYPE_BY_CODE.__getitem__, self.types))
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, NoteArray):
+            return self.ticks == other.ticks and self.columns == other.columns and self.types == other.types
+        if isinstance(other, list):
+            return list(self) == other
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"NoteArray({list(self)!r})"
+
+
 class SMChart:
     chart_type: ChartType
     description: str
     difficulty: Difficulty
     meter: int  # TODO
-    notes: list[Note]
 
     def __init__(self):
         self.chart_type = ChartType.DANCE_SINGLE
         self.description = ""
         self.difficulty = Difficulty.BEGINNER
         self.meter = 0
-        self.notes = []
+        self._notes: Optional[NoteArray] = NoteArray()
+        self._note_data: Union[str, bytes, None] = None
+
+    @property
+    def notes(self) -> NoteArray:
+        """The chart's notes, decoded from the raw note data on first access if the chart was loaded lazily."""
+        if self._notes is None:
+            self._notes = decode_notes(self._note_data)
+            self._note_data = None
+        return self._notes
+
+    @notes.setter
+    def notes(self, notes: Iterable[Note]):
+        self._notes = notes if isinstance(notes, NoteArray) else NoteArray(notes)
+        self._note_data = None
+
+    @property
+    def notes_decoded(self) -> bool:
+        return self._notes is not None
+
+    def defer_notes(self, note_data: Union[str, bytes]):
+        """Keep the raw note data around and only decode it when the notes are first needed."""
+        self._notes = None
+        self._note_data = note_data
+
+    def fingerprint(self) -> bytes:
+        """A digest of the chart's header and notes, it changes whenever the chart does.
+
+        Charts loaded lazily are hashed from their raw note data without decoding it,
+        so only compare fingerprints of charts that were loaded the same way.
+        """
+        digest = hashlib.sha256()
+        digest.update(repr((self.chart_type.value, self.description, self.difficulty.value, self.meter)).encode())
+        if self._notes is None:
+            digest.update(b"raw:")
+            digest.update(self._note_data.encode() if isinstance(self._note_data, str) else self._note_data)
+        else:
+            digest.update(b"decoded:")
+            for column in (self._notes.ticks, self._notes.columns, self._notes.types):
+                digest.update(column.tobytes())
+        return digest.digest()
 
 
 class SMSong:
@@ -74,6 +187,9 @@ class SMSong:
     sample_start: float
     sample_duration: float
     bpm_changes: list[BPMChange]
+    stops: list[Stop]
+    delays: list[Stop]
+    warps: list[Warp]
     charts: list[SMChart]
 
     def __init__(self):
@@ -86,72 +202,129 @@ class SMSong:
         self.sample_start = 0.0
         self.sample_duration = 0.0
         self.bpm_changes = []
+        self.stops = []
+        self.delays = []
+        self.warps = []
         self.charts = []
 
+    def tempo_map(self, sample_rate: int = 44100) -> TempoMap:
+        """The song's full timing, including stops, delays and warps."""
+        return TempoMap(self.bpm_changes, sample_rate=sample_rate, stops=self.stops, delays=self.delays,
+                        warps=self.warps)
 
-def read_msd_from_string(s: str, escape_chars: bool) -> list[list[str]]:
+    def timing_fingerprint(self) -> bytes:
+        """A digest of the song's timing, every chart converts differently once it changes."""
+        timing = (self.bpm_changes, self.stops, self.delays, self.warps)
+        return hashlib.sha256(repr(timing).encode()).digest()
+
+
+_MSD_OUTER_SPECIAL = re.compile(r"[#/]")
+_MSD_OUTER_SPECIAL_ESC = re.compile(r"[#/\\]")
+_MSD_VALUE_SPECIAL = re.compile(r"[#:;/]")
+_MSD_VALUE_SPECIAL_ESC = re.compile(r"[#:;/\\]")
+_MSD_OUTER_SPECIAL_BYTES = re.compile(rb"[#/]")
+_MSD_OUTER_SPECIAL_ESC_BYTES = re.compile(rb"[#/\\]")
+_MSD_VALUE_SPECIAL_BYTES = re.compile(rb"[#:;/]")
+_MSD_VALUE_SPECIAL_ESC_BYTES = re.compile(rb"[#:;/\\]")
+# the characters that mean something to the tokenizer: '/', '\\', ':', ';' and a newline
+_MSD_TOKENS = ("/", "\\", ":", ";", "\n")
+_MSD_TOKENS_BYTES = (b"/", b"\\", b":", b";", b"\n")
+
+
+def _skip_msd_comment(s, i: int, newline="\n") -> int:
+    """Return the index just past the end of the comment starting at `i`."""
+    end = s.find(newline, i + 2)
+    return len(s) if end == -1 else end + 1
+
+
+@instrument.stage("smmap.read_msd_from_string", count=len)
+def read_msd_from_string(s: Union[str, bytes, mmap.mmap], escape_chars: bool) -> list[list[AnyStr]]:
     """Based on the stepmania implementation.
 
     https://github.com/stepmania/stepmania/blob/5_1-new/src/MsdFile.h
     https://github.com/stepmania/stepmania/blob/5_1-new/src/MsdFile.cpp
+
+    Instead of stepping through the string one character at a time, this jumps
+    straight to the next character that means something in the current state
+    and slices everything in between as a whole.
+
+    `s` can also be bytes or a memory mapped file, the values are bytes then.
     """
 
+    if isinstance(s, str):
+        tokens = _MSD_TOKENS
+        if escape_chars:
+            outer_special, value_special = _MSD_OUTER_SPECIAL_ESC, _MSD_VALUE_SPECIAL_ESC
+        else:
+            outer_special, value_special = _MSD_OUTER_SPECIAL, _MSD_VALUE_SPECIAL
+    else:
+        tokens = _MSD_TOKENS_BYTES
+        if escape_chars:
+            outer_special, value_special = _MSD_OUTER_SPECIAL_ESC_BYTES, _MSD_VALUE_SPECIAL_ESC_BYTES
+        else:
+            outer_special, value_special = _MSD_OUTER_SPECIAL_BYTES, _MSD_VALUE_SPECIAL_BYTES
+    slash, backslash, colon, semicolon, newline = tokens
+    empty = tokens[0][:0]
+
     values = []
-    param_buffer = StringIO()
-    reading_value = False
+    n = len(s)
     i = 0
 
-    while i < len(s):
-        if s[i:i + 2] == "//":
-            # skip comments entirely
-            i = i + 2
-            while i < len(s) and s[i] != "\n":
-                i += 1
-            i += 1
-            continue
-
-        # The SM implementation corrects for missing semicolons here,
-        # but for now I'm going to assume files are structured correctly.
-        # TODO?
-
-        if s[i] == "#" and not reading_value:
-            values.append([])
-            reading_value = True
-
-        if not reading_value:
-            if escape_chars and s[i] == "\\":
-                # we're skipping escaped characters, probably to avoid
-                # starting a new value when the escaped character is a '#'.
-                # This suggests we're treating anything outside a value
-                # as a comment, ignoring it.
-                i += 2
+    while True:
+        # outside a value, anything but the start of a new value is ignored
+        match = outer_special.search(s, i)
+        if match is None:
+            break
+        i = match.start()
+        char = match.group()
+
+        if char == slash:
+            if s[i + 1:i + 2] == slash:
+                i = _skip_msd_comment(s, i, newline)
             else:
                 i += 1
             continue
 
-        if s[i] in ":;":
-            values[-1].append(param_buffer.getvalue())
-            param_buffer = StringIO()
-
-        if s[i] in "#:":
-            i += 1
+        if char == backslash:
+            # we're skipping escaped characters, probably to avoid
+            # starting a new value when the escaped character is a '#'.
+            i += 2
             continue
 
-        if s[i] == ";":
-            reading_value = False
-            i += 1
-            continue
-
-        if escape_chars and s[i] == "\\":
-            i += 1
-
-        if i < len(s):
-            param_buffer.write(s[i])
+        # The SM implementation corrects for missing semicolons here,
+        # but for now I'm going to assume files are structured correctly.
+        # TODO?
 
+        params = []
+        parts = []
         i += 1
+        while True:
+            match = value_special.search(s, i)
+            if match is None:
+                raise ValueError("Reached EOF while parsing a value.")
+            j = match.start()
+            if j > i:
+                parts.append(s[i:j])
+            char = match.group()
+            i = j + 1
+
+            if char == colon or char == semicolon:
+                params.append(empty.join(parts))
+                parts = []
+                if char == semicolon:
+                    break
+            elif char == slash:
+                if s[i:i + 1] == slash:
+                    i = _skip_msd_comment(s, j, newline)
+                else:
+                    parts.append(char)
+            elif char == backslash:
+                if i < n:
+                    parts.append(s[i:i + 1])
+                i += 1
+            # a stray '#' inside a value is dropped
 
-    if reading_value:
-        raise ValueError("Reached EOF while parsing a value.")
+        values.append(params)
 
     return values
 
@@ -167,57 +340,332 @@ def process_bpm_changes(sm_song: SMSong, msd_value: list[str]):
         sm_song.bpm_changes.append(BPMChange(beat, new_bpm))
 
 
-def process_notes(sm_song: SMSong, msd_value: list[str]):
-    sm_chart = SMChart()
-    sm_chart.chart_type = ChartType(msd_value[1].strip())
-    sm_chart.description = msd_value[2].strip()
-    sm_chart.difficulty = Difficulty(msd_value[3].strip())
-    sm_chart.meter = int(msd_value[4])
+def _parse_beat_values(value: str) -> Iterator[tuple[float, float]]:
+    for pair_str in value.split(","):
+        if not pair_str.strip():
+            continue
+        beat_str, value_str = pair_str.split("=")
+        yield float(beat_str), float(value_str)
+
+
+def process_stops(stops: list[Stop], msd_value: list[str]):
+    for beat, duration in _parse_beat_values(msd_value[1]):
+        stops.append(Stop(beat, duration))
+
+
+def process_warps(sm_song: SMSong, msd_value: list[str]):
+    for beat, length in _parse_beat_values(msd_value[1]):
+        sm_song.warps.append(Warp(beat, length))
+
+
+@instrument.stage("smmap.decode_notes", count=len)
+def decode_notes(note_data: Union[str, bytes]) -> NoteArray:
+    """Decode the note data of a chart, as text or as the raw bytes from the file."""
+    if not isinstance(note_data, str):
+        return _decode_note_bytes(note_data)
+
+    notes = NoteArray()
+    ticks, columns, types = notes.ticks, notes.columns, notes.types
 
-    for measure_idx, measure_str in enumerate(msd_value[6].split(',')):
+    for measure_idx, measure_str in enumerate(note_data.split(',')):
         rows = measure_str.strip().split('\n')
         ticks_per_row, remainder = divmod(TICKS_PER_MEASURE, len(rows))
         if remainder != 0:
             raise ValueError(f"Invalid number of rows in measure {measure_idx}: {len(rows)}")
         for row_idx, row_str in enumerate(rows):
+            if not row_str.strip('0'):
+                continue
             tick = measure_idx * TICKS_PER_MEASURE + row_idx * ticks_per_row
             for col_idx, note_val in enumerate(row_str):
                 if note_val != '0':
-                    sm_chart.notes.append(Note(tick, col_idx, NoteType(note_val)))
+                    code = _NOTE_CODE_BY_CHAR.get(note_val)
+                    if code is None:
+                        raise ValueError(f"{note_val!r} is not a valid NoteType")
+                    ticks.append(tick)
+                    columns.append(col_idx)
+                    types.append(code)
+
+    return notes
+
+
+def _decode_note_bytes(note_data: bytes) -> NoteArray:
+    notes = NoteArray()
+    ticks, columns, types = notes.ticks, notes.columns, notes.types
+    if b"\r" in note_data:
+        # same as reading the file in text mode
+        note_data = note_data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+    for measure_idx, measure in enumerate(note_data.split(b",")):
+        rows = measure.strip().split(b"\n")
+        ticks_per_row, remainder = divmod(TICKS_PER_MEASURE, len(rows))
+        if remainder != 0:
+            raise ValueError(f"Invalid number of rows in measure {measure_idx}: {len(rows)}")
+        for row_idx, row in enumerate(rows):
+            if not row.strip(b"0"):
+                continue
+            tick = measure_idx * TICKS_PER_MEASURE + row_idx * ticks_per_row
+            for col_idx, code in enumerate(row):
+                if code != _EMPTY_NOTE_CODE:
+                    if code not in _NOTE_CODES:
+                        raise ValueError(f"{chr(code)!r} is not a valid NoteType")
+                    ticks.append(tick)
+                    columns.append(col_idx)
+                    types.append(code)
+
+    return notes
+
+
+@instrument.stage("smmap.process_notes")
+def process_notes(sm_song: SMSong, msd_value: list[str], lazy: bool = False):
+    sm_chart = SMChart()
+    sm_chart.chart_type = ChartType(msd_value[1].strip())
+    sm_chart.description = msd_value[2].strip()
+    sm_chart.difficulty = Difficulty(msd_value[3].strip())
+    sm_chart.meter = int(msd_value[4])
+
+    if lazy:
+        sm_chart.defer_notes(msd_value[6])
+    else:
+        sm_chart.notes = decode_notes(msd_value[6])
 
     sm_song.charts.append(sm_chart)
 
 
-def load_sm(fp: str) -> SMSong:
-    with open(fp, "rt", encoding="utf-8") as f:
-        data = f.read()
+# tags that set the timing of a whole song, .ssc files can repeat them per chart
+_TIMING_TAGS = {"OFFSET", "BPMS", "STOPS", "FREEZES", "DELAYS", "WARPS"}
+
+
+def process_song_tag(sm_song: SMSong, tag_name: str, msd_value: list[str]) -> bool:
+    """Handle a tag shared by .sm and .ssc files, returns whether it was recognised."""
+    if tag_name == "TITLE":
+        sm_song.title = msd_value[1]
+    elif tag_name == "SUBTITLE":
+        sm_song.sub_title = msd_value[1]
+    elif tag_name == "ARTIST":
+        sm_song.artist = msd_value[1]
+    elif tag_name == "CREDIT":
+        sm_song.credit = msd_value[1]
+    elif tag_name == "MUSIC":
+        sm_song.music_path = msd_value[1]
+    elif tag_name == "OFFSET":
+        sm_song.start_offset = float(msd_value[1])
+    elif tag_name == "SAMPLESTART":
+        sm_song.sample_start = float(msd_value[1])  # TODO, see HHMMSSToSeconds in SM
+    elif tag_name == "SAMPLELENGTH":
+        sm_song.sample_duration = float(msd_value[1])  # TODO ^
+    elif tag_name == "BPMS":
+        process_bpm_changes(sm_song, msd_value)
+    elif tag_name in ("STOPS", "FREEZES"):
+        process_stops(sm_song.stops, msd_value)
+    elif tag_name == "DELAYS":
+        process_stops(sm_song.delays, msd_value)
+    elif tag_name == "WARPS":
+        process_warps(sm_song, msd_value)
+    else:
+        return False
+    return True
+
+
+# tried in order when no encoding is given, Shift-JIS is common in older packs and latin-1 never fails
+DETECTED_ENCODINGS = ("utf-8", "cp932", "latin-1")
+# encodings in which a backslash byte is never part of another character, as named by codecs.lookup()
+_BYTE_ESCAPE_ENCODINGS = frozenset({"utf-8", "ascii", "iso8859-1"})
+
+
+@contextmanager
+def _map_file(fp: str) -> Iterator[Union[bytes, mmap.mmap]]:
+    with open(fp, "rb") as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can't be mapped
+            yield b""
+            return
+        with mapped:
+            yield mapped
+
+
+def _decode_text(field: bytes, encoding: str) -> str:
+    text = field.decode(encoding)
+    if "\r" in text:
+        # same as reading the file in text mode
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def _decode_msd_values(raw_values: list[list[bytes]], encoding: str) -> list[list[Union[str, bytes]]]:
+    values = []
+    for raw_value in raw_values:
+        tag_name = _decode_text(raw_value[0], encoding)
+        if tag_name.upper() in ("NOTES", "NOTES2") and len(raw_value) > 1:
+            # note data is left as bytes for decode_notes
+            values.append([tag_name, *(_decode_text(field, encoding) for field in raw_value[1:-1]), raw_value[-1]])
+        else:
+            values.append([_decode_text(field, encoding) for field in raw_value])
+    return values
+
+
+def _read_msd_values_as(data: Union[bytes, mmap.mmap], encoding: str) -> list[list[Union[str, bytes]]]:
+    if codecs.lookup(encoding).name in _BYTE_ESCAPE_ENCODINGS:
+        return _decode_msd_values(read_msd_from_string(data, True), encoding)
+    # a backslash byte can be part of another character, e.g. the second byte of one in Shift-JIS,
+    # so the tokenizer can only tell escapes apart once the whole file is decoded
+    return read_msd_from_string(_decode_text(data[:], encoding), True)
+
+
+def _read_msd_values(
+        data: Union[bytes, mmap.mmap],
+        encoding: Optional[str],
+        report: Diagnostics
+) -> list[list[Union[str, bytes]]]:
+    """Tokenize a file and decode every value but note data, the last field of a NOTES tag.
+
+    In encodings where a backslash byte is always a backslash, like UTF-8, the raw bytes
+    are tokenized and only the values are decoded, note data is left as bytes. Files in
+    other encodings are decoded whole and tokenized as text.
+
+    Without an `encoding`, the first of DETECTED_ENCODINGS that decodes the file is used.
+    """
+    if encoding is not None:
+        return _read_msd_values_as(data, encoding)
 
+    for candidate in DETECTED_ENCODINGS[:-1]:
+        try:
+            values = _read_msd_values_as(data, candidate)
+        except UnicodeDecodeError:
+            continue
+        break
+    else:
+        candidate = DETECTED_ENCODINGS[-1]
+        values = _read_msd_values_as(data, candidate)
+
+    if candidate != DETECTED_ENCODINGS[0]:
+        report.add(SONG_SCOPE, IssueKind.NOT_UTF8, detail=candidate)
+    return values
+
+
+def load_sm(
+        fp: str,
+        lazy: bool = False,
+        diagnostics: Optional[Diagnostics] = None,
+        encoding: Optional[str] = None
+) -> SMSong:
+    """Load a .sm file.
+
+    The file is memory mapped and decoded with `encoding` or else a detected one
+    (see `load_sm_from_bytes`).
+    """
+    with _map_file(fp) as data:
+        return load_sm_from_bytes(data, lazy, diagnostics, encoding)
+
+
+def load_sm_from_bytes(
+        data: Union[bytes, mmap.mmap],
+        lazy: bool = False,
+        diagnostics: Optional[Diagnostics] = None,
+        encoding: Optional[str] = None
+) -> SMSong:
+    """Load a .sm file from its contents.
+
+    With `lazy` set, the note data of each chart is only decoded the first time
+    its `notes` are accessed, so reading just the metadata stays cheap.
+
+    Metadata is decoded with `encoding` if given, otherwise with the first of
+    DETECTED_ENCODINGS that works. Note data of UTF-8 files is parsed straight
+    from the bytes, without decoding the whole file.
+
+    Problems like ignored tags are added to `diagnostics`, or logged in one
+    summary once the file is loaded if it isn't given.
+    """
+    report = diagnostics if diagnostics is not None else Diagnostics()
     sm_song = SMSong()
 
-    for msd_value in read_msd_from_string(data, True):
+    for msd_value in _read_msd_values(data, encoding, report):
         tag_name = msd_value[0].upper()
 
-        if tag_name == "TITLE":
-            sm_song.title = msd_value[1]
-        elif tag_name == "SUBTITLE":
-            sm_song.sub_title = msd_value[1]
-        elif tag_name == "ARTIST":
-            sm_song.artist = msd_value[1]
-        elif tag_name == "CREDIT":
-            sm_song.credit = msd_value[1]
-        elif tag_name == "MUSIC":
-            sm_song.music_path = msd_value[1]
-        elif tag_name == "OFFSET":
-            sm_song.start_offset = float(msd_value[1])
-        elif tag_name == "SAMPLESTART":
-            sm_song.sample_start = float(msd_value[1])  # TODO, see HHMMSSToSeconds in SM
-        elif tag_name == "SAMPLELENGTH":
-            sm_song.sample_duration = float(msd_value[1])  # TODO ^
-        elif tag_name == "BPMS":
-            process_bpm_changes(sm_song, msd_value)
+        if process_song_tag(sm_song, tag_name, msd_value):
+            pass
         elif tag_name == "NOTES":
-            process_notes(sm_song, msd_value)
+            process_notes(sm_song, msd_value, lazy)
         else:
-            logging.warning(f"Ignoring tag {tag_name}")
+            report.add(SONG_SCOPE, IssueKind.IGNORED_TAG, detail=tag_name)
 
+    if diagnostics is None:
+        report.log()
     return sm_song
+
+
+def load_ssc(
+        fp: str,
+        lazy: bool = False,
+        diagnostics: Optional[Diagnostics] = None,
+        encoding: Optional[str] = None
+) -> SMSong:
+    """Load a .ssc file, like `load_sm`."""
+    with _map_file(fp) as data:
+        return load_ssc_from_bytes(data, lazy, diagnostics, encoding)
+
+
+def load_ssc_from_bytes(
+        data: Union[bytes, mmap.mmap],
+        lazy: bool = False,
+        diagnostics: Optional[Diagnostics] = None,
+        encoding: Optional[str] = None
+) -> SMSong:
+    """Load a .ssc file from its contents.
+
+    Every chart starts at a #NOTEDATA tag and has its header fields in separate
+    tags. Charts with timing of their own (split timing) use the song's timing
+    instead, with a warning. Otherwise this works like `load_sm_from_bytes`.
+    """
+    report = diagnostics if diagnostics is not None else Diagnostics()
+    sm_song = SMSong()
+    song_timing = {}
+    sm_chart = None
+
+    for msd_value in _read_msd_values(data, encoding, report):
+        tag_name = msd_value[0].upper()
+        value = msd_value[1] if len(msd_value) > 1 else ""
+
+        if tag_name == "NOTEDATA":
+            sm_chart = SMChart()
+        elif sm_chart is None:
+            if tag_name in _TIMING_TAGS:
+                song_timing[tag_name] = value
+            if not process_song_tag(sm_song, tag_name, msd_value):
+                report.add(SONG_SCOPE, IssueKind.IGNORED_TAG, detail=tag_name)
+        elif tag_name == "STEPSTYPE":
+            sm_chart.chart_type = ChartType(value.strip())
+        elif tag_name == "DESCRIPTION":
+            sm_chart.description = value.strip()
+        elif tag_name == "DIFFICULTY":
+            sm_chart.difficulty = Difficulty(value.strip())
+        elif tag_name == "METER":
+            sm_chart.meter = int(value)
+        elif tag_name == "NOTES":
+            if lazy:
+                sm_chart.defer_notes(value)
+            else:
+                sm_chart.notes = decode_notes(value)
+            sm_song.charts.append(sm_chart)
+        elif tag_name in _TIMING_TAGS:
+            if value.strip() != song_timing.get(tag_name, "").strip():
+                report.add(SONG_SCOPE, IssueKind.CHART_TIMING, detail=f"{tag_name} of chart {len(sm_song.charts) + 1}")
+        else:
+            logging.debug(f"Ignoring chart tag {tag_name}")
+
+    if diagnostics is None:
+        report.log()
+    return sm_song
+
+
+def load_song(
+        fp: str,
+        lazy: bool = False,
+        diagnostics: Optional[Diagnostics] = None,
+        encoding: Optional[str] = None
+) -> SMSong:
+    """Load a .sm or .ssc file, depending on its extension."""
+    if fp.lower().endswith(".ssc"):
+        return load_ssc(fp, lazy, diagnostics, encoding)
+    return load_sm(fp, lazy, diagnostics, encoding)
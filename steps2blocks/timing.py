@@ -0,0 +1,194 @@
+from bisect import bisect_right
+from typing import Iterable, Optional, Protocol
+
+
+class TempoChange(Protocol):
+    """Anything with a beat and a new BPM, like smmap.BPMChange and bsmap.BPMEvent."""
+    beat: float
+    new_bpm: float
+
+
+class Pause(Protocol):
+    """A stop or delay, like smmap.Stop."""
+    beat: float
+    duration: float
+
+
+class Skip(Protocol):
+    """A warp, like smmap.Warp."""
+    beat: float
+    length: float
+
+
+class TempoMap:
+    """Conversion between beats, seconds and sample positions for a song's timing.
+
+    The timing is split into segments at every beat where something happens: a BPM
+    change, stop, delay, or the start or end of a warp. The position of each segment
+    start in beats, seconds and samples is computed once, so every query is a binary
+    search over the segments. The batch variants walk the segments alongside their
+    input instead, which is linear for sorted input.
+
+    Like in StepMania, a stop pauses the song right after the notes on its beat and a
+    delay right before them. Beats inside a warp take no time at all.
+    """
+
+    def __init__(
+            self,
+            changes: Iterable[TempoChange],
+            initial_bpm: Optional[float] = None,
+            sample_rate: int = 44100,
+            stops: Iterable[Pause] = (),
+            delays: Iterable[Pause] = (),
+            warps: Iterable[Skip] = ()
+    ):
+        changes = list(changes)
+        if initial_bpm is None:
+            if not changes or changes[0].beat != 0.0:
+                raise ValueError("Missing bpm at beat 0")
+            initial_bpm = changes[0].new_bpm
+
+        bpm_at = {}
+        previous_beat = 0.0
+        for change in changes:
+            if change.beat == 0.0:
+                continue
+            if change.beat < previous_beat:
+                raise ValueError(f"BPM changes are out of order at beat {change.beat}")
+            bpm_at[change.beat] = change.new_bpm
+            previous_beat = change.beat
+
+        stop_at = {}
+        for stop in stops:
+            stop_at[stop.beat] = stop_at.get(stop.beat, 0.0) + stop.duration
+        delay_at = {}
+        for delay in delays:
+            delay_at[delay.beat] = delay_at.get(delay.beat, 0.0) + delay.duration
+        warps = sorted((warp.beat, warp.beat + warp.length) for warp in warps if warp.length > 0)
+
+        breakpoints = {0.0, *bpm_at, *stop_at, *delay_at}
+        for warp_start, warp_end in warps:
+            breakpoints.update((warp_start, warp_end))
+
+        self.sample_rate = sample_rate
+        self.has_pauses = bool(stop_at or delay_at or warps)
+        # per segment start: its beat, the BPM from there on, when notes on it are hit,
+        # how long the song stops after that and whether the segment is warped over
+        self.beats = []
+        self.bpms = []
+        self.seconds = []
+        self.samples = []
+        self.delays = []
+        self.stops = []
+        self.warped = []
+
+        seconds = samples = 0.0
+        bpm = initial_bpm
+        warp_idx = 0
+        warp_end = float("-inf")
+        for beat in sorted(b for b in breakpoints if b >= 0.0):
+            if self.beats:
+                if not self.warped[-1]:
+                    beats_per_second = bpm / 60
+                    seconds += (beat - self.beats[-1]) / beats_per_second
+                    samples += sample_rate * (beat - self.beats[-1]) / beats_per_second
+                seconds += self.stops[-1]
+                samples += sample_rate * self.stops[-1]
+            delay = delay_at.get(beat, 0.0)
+            seconds += delay
+            samples += sample_rate * delay
+            bpm = bpm_at.get(beat, bpm)
+            while warp_idx < len(warps) and warps[warp_idx][0] <= beat:
+                warp_end = max(warp_end, warps[warp_idx][1])
+                warp_idx += 1
+
+            self.beats.append(beat)
+            self.bpms.append(bpm)
+            self.seconds.append(seconds)
+            self.samples.append(samples)
+            self.delays.append(delay)
+            self.stops.append(stop_at.get(beat, 0.0))
+            self.warped.append(beat < warp_end)
+
+    def __len__(self) -> int:
+        """The number of timing segments."""
+        return len(self.beats)
+
+    def segment_at_beat(self, beat: float) -> int:
+        return max(bisect_right(self.beats, beat) - 1, 0)
+
+    def segment_at_seconds(self, seconds: float) -> int:
+        return max(bisect_right(self.seconds, seconds) - 1, 0)
+
+    def _seconds_in(self, idx: int, beat: float) -> float:
+        if beat == self.beats[idx]:
+            return self.seconds[idx]
+        if self.warped[idx]:
+            return self.seconds[idx] + self.stops[idx]
+        return self.seconds[idx] + self.stops[idx] + (beat - self.beats[idx]) / (self.bpms[idx] / 60)
+
+    def _samples_in(self, idx: int, beat: float) -> float:
+        if beat == self.beats[idx]:
+            return self.samples[idx]
+        if self.warped[idx]:
+            return self.samples[idx] + self.sample_rate * self.stops[idx]
+        return self.samples[idx] + self.sample_rate * (
+                self.stops[idx] + (beat - self.beats[idx]) / (self.bpms[idx] / 60))
+
+    def _beat_in(self, idx: int, seconds: float) -> float:
+        moving_from = self.seconds[idx] + self.stops[idx]
+        if seconds <= moving_from:
+            return self.beats[idx]
+        if self.warped[idx]:
+            beat = float("inf")
+        else:
+            beat = self.beats[idx] + (seconds - moving_from) * self.bpms[idx] / 60
+        if idx + 1 < len(self.beats):
+            # past the next segment start we're waiting out its delay
+            beat = min(beat, self.beats[idx + 1])
+        return beat
+
+    def _warped_in(self, idx: int, beat: float) -> bool:
+        if beat == self.beats[idx]:
+            return self.warped[idx] and not self.stops[idx] and not self.delays[idx]
+        return self.warped[idx]
+
+    def beat_to_seconds(self, beat: float) -> float:
+        return self._seconds_in(self.segment_at_beat(beat), beat)
+
+    def seconds_to_beat(self, seconds: float) -> float:
+        return self._beat_in(self.segment_at_seconds(seconds), seconds)
+
+    def beat_to_sample(self, beat: float) -> float:
+        return self._samples_in(self.segment_at_beat(beat), beat)
+
+    def is_warped(self, beat: float) -> bool:
+        """Whether notes on this beat are skipped over by a warp."""
+        return self._warped_in(self.segment_at_beat(beat), beat)
+
+    def _sweep(self, values: Iterable[float], starts: list[float], convert) -> list:
+        results = []
+        idx = 0
+        last_idx = len(starts) - 1
+        previous = None
+        for value in values:
+            if previous is not None and value < previous:
+                # not sorted, start searching from scratch
+                idx = max(bisect_right(starts, value) - 1, 0)
+            while idx < last_idx and starts[idx + 1] <= value:
+                idx += 1
+            results.append(convert(idx, value))
+            previous = value
+        return results
+
+    def beats_to_seconds(self, beats: Iterable[float]) -> list[float]:
+        return self._sweep(beats, self.beats, self._seconds_in)
+
+    def seconds_to_beats(self, seconds: Iterable[float]) -> list[float]:
+        return self._sweep(seconds, self.seconds, self._beat_in)
+
+    def beats_to_samples(self, beats: Iterable[float]) -> list[float]:
+        return self._sweep(beats, self.beats, self._samples_in)
+
+    def warped_beats(self, beats: Iterable[float]) -> list[bool]:
+        return self._sweep(beats, self.beats, self._warped_in)
@@ -0,0 +1,133 @@
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, NamedTuple, Optional
+
+from audio import place_audio
+from audioprobe import AudioInfo
+from batch import BatchJob, ConversionSettings
+from bsmap import BeatMap, DifficultyBeatmap
+from convert import beatmap_from_sm
+from diagnostics import Diagnostics
+from smmap import load_song
+
+DEFAULT_INTERVAL = 0.1  # seconds
+
+
+class UpdateResult(NamedTuple):
+    job: BatchJob
+    converted: int  # charts converted, the others were reused from the previous update
+    total: int
+    written: list[str]  # files written, not including the audio
+    elapsed: float
+    error: Optional[str] = None
+    warnings: tuple[str, ...] = ()  # of the song and the charts that were converted
+
+
+def _file_stat(path: Path) -> Optional[tuple[int, int, int]]:
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class SongWatcher:
+    """Keeps a song's map up to date with its .sm or .ssc file.
+
+    Every update parses the file again, lazily, and fingerprints the raw note data of
+    every chart. Charts whose fingerprint is unchanged keep their converted difficulty
+    from the previous update, and only the difficulty files of the other charts are
+    written again, along with Info.dat. Changes to the timing or the audio of the song
+    convert every chart again.
+    """
+
+    def __init__(self, job: BatchJob, settings: ConversionSettings = ConversionSettings()):
+        self.job = job
+        self.settings = settings
+        self.file_stat: Optional[tuple[int, int, int]] = None
+        self.beatmap: Optional[BeatMap] = None
+        self.song_key = None
+        self.audio_info: Optional[AudioInfo] = None
+        self.chart_maps: dict[bytes, DifficultyBeatmap] = {}  # by chart fingerprint
+
+    def changed(self) -> bool:
+        """Whether the file changed since the last update. A missing file, e.g. while it's being saved, hasn't."""
+        file_stat = _file_stat(self.job.sm_path)
+        return file_stat is not None and file_stat != self.file_stat
+
+    def update(self) -> UpdateResult:
+        """Convert what changed since the last update, never raising: failures are reported in the result."""
+        start = time.perf_counter()
+        self.file_stat = _file_stat(self.job.sm_path)
+        diagnostics = Diagnostics()
+        try:
+            sm_song = load_song(str(self.job.sm_path), lazy=True, diagnostics=diagnostics,
+                                encoding=self.settings.encoding)
+            audio_path = self.job.sm_path.parent / sm_song.music_path if sm_song.music_path else None
+            audio_stat = _file_stat(audio_path) if audio_path is not None else None
+            song_key = (sm_song.timing_fingerprint(), sm_song.music_path, audio_stat)
+            fingerprints = [chart.fingerprint() for chart in sm_song.charts]
+
+            reuse = {}
+            if song_key == self.song_key:
+                reuse = {idx: self.chart_maps[fingerprint] for idx, fingerprint in enumerate(fingerprints)
+                         if fingerprint in self.chart_maps}
+
+            audio_info = self.audio_info
+            if self.song_key is None or song_key[1:] != self.song_key[1:]:
+                audio_info = self.settings.audio_info(audio_path)
+            bs_song = beatmap_from_sm(sm_song, audio_info.sample_count, audio_info.sample_rate,
+                                      self.settings.hold_policy, diagnostics=diagnostics, reuse=reuse)
+            diff_maps = bs_song.difficulty_beatmap_sets[0].diff_maps
+            converted = [dm.filename for idx, dm in enumerate(diff_maps) if idx not in reuse]
+
+            if self.beatmap is None:
+                written = bs_song.filenames()
+                self.job.output_path.mkdir(parents=True, exist_ok=True)
+                bs_song.save_to_disk(self.job.output_path)
+            else:
+                written = ["Info.dat", *(["BPMInfo.dat"] if bs_song.bpm_info is not None else []), *converted]
+                bs_song.save_to_disk(self.job.output_path, only=converted)
+                # difficulty files of charts that are gone
+                for filename in set(self.beatmap.filenames()) - set(bs_song.filenames()):
+                    (self.job.output_path / filename).unlink(missing_ok=True)
+
+            if audio_path is not None and audio_stat is not None:
+                song_dst = self.job.output_path / bs_song.song_filename
+                if self.song_key is not None and song_key[1:] != self.song_key[1:]:
+                    song_dst.unlink(missing_ok=True)
+                place_audio(audio_path, song_dst)
+        except Exception as e:
+            return UpdateResult(self.job, 0, 0, [], time.perf_counter() - start, f"{type(e).__name__}: {e}",
+                                tuple(diagnostics.summaries()))
+
+        self.beatmap = bs_song
+        self.song_key = song_key
+        self.audio_info = audio_info
+        self.chart_maps = dict(zip(fingerprints, diff_maps))
+        return UpdateResult(self.job, len(converted), len(diff_maps), written, time.perf_counter() - start,
+                            warnings=tuple(diagnostics.summaries()))
+
+
+def watch(
+        jobs: Iterable[BatchJob],
+        settings: ConversionSettings = ConversionSettings(),
+        on_update: Optional[Callable[[UpdateResult], None]] = None,
+        interval: float = DEFAULT_INTERVAL,
+        stop: Optional[threading.Event] = None
+):
+    """Convert every job, then poll their files every `interval` seconds and update the maps of those that changed.
+
+    Runs until `stop` is set, calling `on_update` with the result of every update.
+    """
+    watchers = [SongWatcher(job, settings) for job in jobs]
+    stop = stop if stop is not None else threading.Event()
+    while True:
+        for watcher in watchers:
+            if watcher.changed():
+                result = watcher.update()
+                if on_update is not None:
+                    on_update(result)
+        if stop.wait(interval):
+            return